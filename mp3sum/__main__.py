@@ -4,27 +4,61 @@
 Script entry point.
 """
 
+import itertools
 import os
 import sys
 import signal
 import time
-import multiprocessing
 
 # Support direct calls to __main__.py
 if __package__ is None and not hasattr(sys, 'frozen'):
   path = os.path.realpath(os.path.abspath(__file__))
   sys.path.insert(0, os.path.dirname(os.path.dirname(path)))
 
+from mp3sum import archives
 from mp3sum import arguments
+from mp3sum import cache
+from mp3sum import discovery
+from mp3sum import engine
 from mp3sum import logging
+from mp3sum import profiling
+from mp3sum import progress as reporting
+from mp3sum import util
 from mp3sum import verifier
 
+def _report(logger, options, result, outputs):
+  """
+  Prints a result and writes it to any other outputs.
+  """
+  if options.format == 'text':
+    verifier.print_result(logger, options, result)
+
+  for output in outputs:
+    output.write(result)
+
+def _verify_stdin(options):
+  """
+  Verifies an MP3 file piped to standard input.
+  """
+  handle = getattr(sys.stdin, 'buffer', sys.stdin)
+  yield verifier.verify_mp3_stream(handle, '-', options)
+
+def _skip_done(checkpoint, results):
+  """
+  Drops the results for files that have a result in a checkpoint already.
+  """
+  if checkpoint is None:
+    return results
+
+  return (r for r in results if not checkpoint.is_done(r.path))
+
 def main(argv=None):
   """
   Main script routine.
   """
   result_seen = 0
   result_pass = 0
+  result_tag  = 0
   result_skip = 0
   result_fail = 0
 
@@ -32,84 +66,285 @@ def main(argv=None):
   argv    = sys.argv[1:] if argv is None else argv
   parser  = arguments.init_args()
   options = arguments.parse_args(argv, parser)
+  command = options.command
   logger  = logging.Logger(options.log_level, colour = options.colour)
   paths   = []
+  targets = options.path
+
+  # Whether files are to be verified (as opposed to results read back)
+  verifying = command in (None, 'manifest create')
+
+  if command == 'manifest create':
+    from mp3sum import manifest
+
+    targets = options.path[1:]
+
+    if options.digest is None:
+      options.digest = manifest.get_default_digest()
+
+  if command == 'manifest check' and len(options.path) > 1:
+    parser.print_usage(sys.stderr)
+    logger.warn(
+      'error: only one manifest may be checked', prefix = True, file = sys.stderr
+    )
+    return 1
 
-  if options.path is None or len(options.path) == 0:
+  if options.serve is None and not targets:
     parser.print_usage(sys.stderr)
     logger.warn('error: path not supplied', prefix = True, file = sys.stderr)
     return 1
 
-  for path in options.path:
+  for path in targets:
+    # Standard input
+    if path == '-' and command is None:
+      paths.append(path)
     # Path is non-existent
-    if not os.path.exists(path):
+    elif not os.path.exists(path):
       logger.warn('file not found: %s' % path, prefix = True, file = sys.stderr)
       ret |= 1
-    # Path is a directory
-    elif os.path.isdir(path):
-      # Recursive — walk all files recursively
-      if options.recursive:
-        for root, sub_dirs, sub_files in os.walk(path):
-          sub_files.sort()
-          for sub_file in sub_files:
-            sf = os.path.join(root, sub_file)
-            if verifier.is_mp3(sf):
-              paths.append(sf)
-      # Non-recursive — get files in immediate directory
-      else:
-        sub_files = os.listdir(path)
-        sub_files.sort()
-        for sub_file in sub_files:
-          sf = os.path.join(path, sub_file)
-          if os.path.isfile(sf) and verifier.is_mp3(sf):
-            paths.append(sf)
-    # Path is a file
     else:
       paths.append(path)
 
-  pool    = multiprocessing.Pool(options.workers)
-  results = []
+  store = None
 
-  logger.info('Running with %d worker thread(s)' % options.workers)
-  logger.debug('')
+  if command == 'merge':
+    from mp3sum import sinks
 
-  try:
-    for path in paths:
-      pool.apply_async(
-        verifier.verify_mp3,
-        args     = [path, logger, options],
-        callback = lambda x: results.append(x)
+    try:
+      results = sinks.merge_results(paths)
+    except (IOError, OSError, ValueError, KeyError, sinks.sqlite3.Error) as e:
+      logger.warn('cannot read results: %s' % e, prefix = True, file = sys.stderr)
+      return 1
+
+  if command == 'manifest check':
+    from mp3sum import manifest
+
+    if not paths:
+      return ret
+
+    try:
+      results = manifest.check(paths[0], options)
+    except (IOError, OSError, ValueError) as e:
+      logger.warn('cannot read manifest: %s' % e, prefix = True, file = sys.stderr)
+      return 1
+
+  if options.cache is not False and options.connect is None and verifying:
+    try:
+      store = cache.Cache(options.cache)
+    except (IOError, OSError, cache.sqlite3.Error) as e:
+      logger.warn('cache unavailable: %s' % e, prefix = True, file = sys.stderr)
+
+  # Selecting the CRC-16 backend can import numpy, so it's only done when
+  # there's someone to tell
+  if (
+    options.connect is None and command != 'merge'
+    and options.log_level <= logging.INFO
+  ):
+    logger.info('Running with %d worker thread(s)' % options.workers)
+    logger.info('Using %s CRC-16 backend' % util.select_crc16_backend())
+    logger.debug('')
+
+  if options.serve is not None and command is None:
+    from mp3sum import server
+
+    try:
+      server.serve(options.serve, options, logger, store)
+    except (IOError, OSError) as e:
+      logger.warn('cannot serve: %s' % e, prefix = True, file = sys.stderr)
+      ret |= 1
+    except (KeyboardInterrupt, SystemExit):
+      pass
+    finally:
+      if store is not None:
+        store.close()
+    return ret
+
+  profile  = profiling.Profile() if options.profile else None
+  progress = None
+  outputs  = []
+  summary  = sys.stdout
+
+  if options.format == 'jsonl':
+    from mp3sum import sinks
+
+    outputs.append(sinks.JsonLinesSink(sys.stdout, options))
+    # Keep stdout parseable
+    summary = sys.stderr
+
+  if options.output_db:
+    from mp3sum import sinks
+
+    try:
+      outputs.append(sinks.SqliteSink(options.output_db))
+    except (IOError, OSError, sinks.sqlite3.Error) as e:
+      logger.warn(
+        'output database unavailable: %s' % e, prefix = True, file = sys.stderr
       )
+      return 1
 
-    pool.close()
-    pool.join()
+  if command == 'manifest create':
+    outputs.append(manifest.ManifestSink(options.path[0]))
+
+  checkpoint = None
+  replayed   = []
+
+  if options.checkpoint and verifying:
+    from mp3sum import sinks
+
+    try:
+      checkpoint = sinks.CheckpointSink(options.checkpoint, options.resume)
+    except (IOError, OSError, ValueError, KeyError) as e:
+      logger.warn('checkpoint unavailable: %s' % e, prefix = True, file = sys.stderr)
+      return 1
+
+    outputs.append(checkpoint)
+    replayed = list(checkpoint.results.values())
+
+    if replayed:
+      logger.info('Resuming after %d checked file(s)' % len(replayed))
+
+  # Otherwise, the results have been read already
+  if verifying and options.connect is not None:
+    from mp3sum import server
+
+    results = server.request(
+      options.connect,
+      paths,
+      recursive = options.recursive,
+      ordered   = options.ordered,
+      rehash    = options.rehash,
+      shard     = options.shard
+    )
+
+    # The server finds the files, so they can only be skipped afterwards
+    results = _skip_done(checkpoint, results)
+  elif verifying and options.watch:
+    from mp3sum import watcher
+
+    results = watcher.run(paths, options, store, logger)
+  elif verifying:
+    # Archives and standard input are read by a verifier of their own, from
+    # start to end
+    archived = [path for path in paths if archives.is_archive(path)]
+    piped    = '-' in paths
+    paths    = [path for path in paths if path not in archived and path != '-']
+    results  = discovery.find_mp3s(paths, options.recursive, shard = options.shard)
+
+    if checkpoint is not None:
+      results = (p for p in results if not checkpoint.is_done(p))
+
+    if profile is not None:
+      results = profile.walk(results)
+
+    if options.progress:
+      progress = reporting.Progress(
+        logger, records = options.batch or not sys.stderr.isatty()
+      ).start()
+
+    results = engine.run(results, options, store, progress = progress)
+
+    # Members and standard input can't be skipped without reading them, so
+    # their results are dropped afterwards instead
+    if archived:
+      results = itertools.chain(
+        results,
+        _skip_done(
+          checkpoint,
+          archives.run(
+            list(discovery.find_mp3s(archived, shard = options.shard)), options
+          )
+        )
+      )
+
+    # First, so that whatever's writing to the pipe isn't kept waiting
+    if piped:
+      results = itertools.chain(
+        _skip_done(checkpoint, _verify_stdin(options)), results
+      )
+
+  # Results from before a resume count towards the summary, but have been
+  # reported already
+  replay = len(replayed)
+
+  try:
+    for result in itertools.chain(replayed, results):
+      if result.result == verifier.ERROR_NOT_MP3:
+        continue
+
+      if replay:
+        replay -= 1
+      else:
+        if progress is not None:
+          with progress:
+            _report(logger, options, result, outputs)
+        else:
+          _report(logger, options, result, outputs)
+
+        # Results trickle in while watching, so don't sit on them
+        if options.watch:
+          sys.stdout.flush()
+
+        if profile is not None:
+          profile.add(result)
+
+      if result.result == verifier.ERROR_OK:
+        result_pass += 1
+      elif result.result == verifier.ERROR_TAG_OK:
+        result_tag  += 1
+      elif result.result == verifier.ERROR_UNSUPPORTED:
+        result_skip += 1
+      elif result.result == verifier.ERROR_TAG_MISMATCH:
+        result_fail += 1
+      elif result.result == verifier.ERROR_MUSIC_MISMATCH:
+        result_fail += 1
+      else:
+        raise NotImplementedError('Unsupported result %i' % result.result)
+
+      result_seen += 1
+
+      if result.result != verifier.ERROR_TAG_OK:
+        ret |= result.result
   except (KeyboardInterrupt, SystemExit):
     logger.error('Interrupted by user.', file = sys.stderr)
+  except (IOError, OSError) as e:
+    if options.connect is None:
+      raise
+    logger.warn('server request failed: %s' % e, prefix = True, file = sys.stderr)
+    ret |= 1
 
-  for result in results:
-    if result == verifier.ERROR_NOT_MP3:
-      continue
-    elif result == verifier.ERROR_OK:
-      result_pass += 1
-    elif result == verifier.ERROR_UNSUPPORTED:
-      result_skip += 1
-    elif result == verifier.ERROR_TAG_MISMATCH:
-      result_fail += 1
-    elif result == verifier.ERROR_MUSIC_MISMATCH:
-      result_fail += 1
-    else:
-      raise NotImplementedError('Unsupported result %i' % result)
-
-    result_seen += 1
-    ret         |= result
-
-  logger.error('%d file(s) checked:' % result_seen, end = ' ')
-  logger.error('%d' % result_pass, fg = 'green', end = ' ')
-  logger.error('pass', end = ', ')
-  logger.error('%d' % result_skip, fg = 'yellow', end = ' ')
-  logger.error('unsupported', end = ', ')
-  logger.error('%d' % result_fail, fg = 'red', end = ' ')
-  logger.error('fail')
+  if progress is not None:
+    progress.stop()
+
+  for output in outputs:
+    try:
+      output.close()
+    # The module sinks uses, without needing sinks to have been imported
+    except (IOError, OSError, cache.sqlite3.Error) as e:
+      logger.warn('failed to write results: %s' % e, prefix = True, file = sys.stderr)
+      ret |= 1
+
+  if store is not None:
+    try:
+      store.close()
+    except cache.sqlite3.Error as e:
+      logger.warn('failed to update cache: %s' % e, prefix = True, file = sys.stderr)
+
+  logger.error('%d file(s) checked:' % result_seen, end = ' ', file = summary)
+  logger.error('%d' % result_pass, fg = 'green', end = ' ', file = summary)
+  logger.error('pass', end = ', ', file = summary)
+  if options.quick or result_tag:
+    logger.error('%d' % result_tag, fg = 'cyan', end = ' ', file = summary)
+    logger.error('tag only', end = ', ', file = summary)
+  logger.error('%d' % result_skip, fg = 'yellow', end = ' ', file = summary)
+  logger.error('unsupported', end = ', ', file = summary)
+  logger.error('%d' % result_fail, fg = 'red', end = ' ', file = summary)
+  logger.error('fail', file = summary)
+
+  if profile is not None:
+    profile.report(
+      logger,
+      options.workers if options.connect is None and command != 'merge' else None
+    )
 
   return 0 if ret == verifier.ERROR_OK else ret
 
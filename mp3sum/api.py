@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+Library interface.
+
+Nothing here prints anything or raises on bad files; every file checked
+produces a VerificationResult:
+
+  from mp3sum import api
+
+  result = api.verify_file('song.mp3')
+
+  if result.result != api.ERROR_OK:
+    print(result)
+
+  for result in api.verify_many(paths, workers = 4):
+    ...
+"""
+
+from mp3sum import arguments
+from mp3sum import engine
+from mp3sum import logging
+from mp3sum import util
+
+from mp3sum.verifier import (
+  ERROR_NOT_MP3,
+  ERROR_OK,
+  ERROR_UNSUPPORTED,
+  ERROR_TAG_MISMATCH,
+  ERROR_MUSIC_MISMATCH,
+  ERROR_TAG_OK,
+  MODE_FULL,
+  MODE_QUICK,
+  VerificationResult,
+  verify_file,
+  verify_stream,
+)
+
+def get_options(**kwargs):
+  """
+  Gets a set of options as the command-line interface would produce them.
+
+  @param mixed **kwargs
+    (optional) Option values to override, by destination name (e.g.,
+    workers, read_size, ordered).
+
+  @return argparse.Namespace
+    The options.
+  """
+  options = arguments.parse_args([], arguments.init_args())
+
+  for name, value in kwargs.items():
+    if not hasattr(options, name):
+      raise TypeError('unknown option: %s' % name)
+    setattr(options, name, value)
+
+  return options
+
+def verify_many(
+  paths,
+  workers        = None,
+  read_size      = util.READ_SIZE,
+  mode           = MODE_FULL,
+  use_mmap       = False,
+  split_size     = engine.SPLIT_SIZE,
+  chunksize      = None,
+  ordered        = False,
+  debug          = False,
+  store          = None,
+  device_workers = None,
+  drop_cache     = False,
+  direct         = False,
+  digest         = None
+):
+  """
+  Verifies files in parallel using the worker pool.
+
+  @param iterable paths
+    The paths of the files to verify. This is consumed lazily, so it may be
+    an unbounded iterator. Directories aren't expanded (see
+    discovery.find_mp3s()).
+
+  @param int workers
+    (optional) The number of worker processes. Defaults to the number of
+    CPUs.
+
+  @param int read_size
+    (optional) See verify_file().
+
+  @param str mode
+    (optional) See verify_file().
+
+  @param bool use_mmap
+    (optional) See verify_file().
+
+  @param int split_size
+    (optional) The audio-stream length above which a file's music CRC is
+    computed across all of the workers, or 0 to disable this.
+
+  @param int chunksize
+    (optional) The maximum number of files sent to a worker in one batch.
+
+  @param bool ordered
+    (optional) Whether to yield results in the same order as paths, rather
+    than in order of completion.
+
+  @param bool debug
+    (optional) Whether to collect debug messages in the results.
+
+  @param cache.Cache store
+    (optional) A result cache to consult and update.
+
+  @param int device_workers
+    (optional) The number of batches that may be read at once from each
+    device, or 0 for no limit. Defaults to engine.ROTATIONAL_WORKERS for
+    spinning disks and no limit for anything else.
+
+  @param bool drop_cache
+    (optional) See verify_file().
+
+  @param bool direct
+    (optional) See verify_file().
+
+  @param str digest
+    (optional) See verify_file().
+
+  @return generator
+    VerificationResult instances, one per path.
+  """
+  options = get_options(
+    read_size      = read_size,
+    quick          = mode == MODE_QUICK,
+    mmap           = use_mmap,
+    split_size     = split_size,
+    chunksize      = chunksize,
+    ordered        = ordered,
+    device_workers = device_workers,
+    drop_cache     = drop_cache,
+    direct         = direct,
+    digest         = digest,
+    log_level      = logging.DEBUG if debug else logging.WARNING
+  )
+
+  if workers is not None:
+    options.workers = workers
+
+  return engine.run(paths, options, store)
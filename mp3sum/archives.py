@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+Verification of MP3s inside tar and zip archives, without extracting them.
+
+Members are read straight out of the archive, one after another, and
+verified as streams (see verifier.verify_stream()); compressed tarballs are
+decompressed on the fly. Results are reported with the member's name
+appended to the archive's path (e.g., 'backup.tar/Album/01.mp3').
+"""
+
+import os
+
+from mp3sum import engine
+from mp3sum import verifier
+
+"""
+The file name suffixes recognised as archives. .tar.zst archives need the
+zstandard module.
+"""
+ARCHIVE_SUFFIXES = (
+  '.tar',
+  '.tar.bz2',
+  '.tar.gz',
+  '.tar.xz',
+  '.tar.zst',
+  '.tbz2',
+  '.tgz',
+  '.txz',
+  '.tzst',
+  '.zip',
+)
+
+# Errors raised by the decompressors and archive modules for bad archives;
+# see _get_errors()
+_errors = None
+
+def _get_errors():
+  """
+  Gets the errors raised for bad archives. The modules involved are only
+  imported once an archive is read, so as not to slow down start-up.
+  """
+  global _errors
+
+  if _errors is None:
+    import tarfile
+    import zipfile
+    import zlib
+
+    errors = (
+      EOFError,
+      IOError,
+      OSError,
+      tarfile.TarError,
+      zipfile.BadZipfile,
+      zlib.error,
+    )
+
+    try:
+      import lzma
+      errors += (lzma.LZMAError,)
+    except ImportError:
+      pass
+
+    _errors = errors
+
+  return _errors
+
+class _Member(object):
+  """
+  Wraps an archive member's stream so that the errors raised when an
+  archive turns out to be corrupt are IOErrors, as for ordinary files.
+  """
+  def __init__(self, handle):
+    self.handle = handle
+
+  def read(self, size=-1):
+    try:
+      return self.handle.read(size)
+    except _get_errors() as e:
+      raise IOError(str(e) or type(e).__name__)
+
+def is_archive(path):
+  """
+  Determines whether a file looks like an archive.
+
+  @param str path
+    The path to the file to check.
+
+  @return bool
+  """
+  return path.lower().endswith(ARCHIVE_SUFFIXES) and os.path.isfile(path)
+
+def _open_zstd(handle):
+  """
+  Gets a stream of the decompressed contents of a zstd-compressed file.
+  """
+  try:
+    import zstandard
+  except ImportError:
+    raise IOError('.tar.zst archives require the zstandard module')
+
+  return zstandard.ZstdDecompressor().stream_reader(handle)
+
+def iter_members(path):
+  """
+  Reads the MP3 files in an archive, in the order they're stored.
+
+  @param str path
+    The path to the archive.
+
+  @return generator
+    (name, size, handle) tuples, where handle is a stream of the member's
+    contents that's only valid until the next tuple is produced.
+
+  @raise IOError
+    If the archive can't be read.
+  """
+  import tarfile
+  import zipfile
+
+  if path.lower().endswith('.zip'):
+    with zipfile.ZipFile(path) as archive:
+      for info in archive.infolist():
+        if info.filename.endswith('/'):
+          continue
+        if not verifier.is_mp3(info.filename, is_file = True):
+          continue
+
+        handle = archive.open(info)
+
+        try:
+          yield (info.filename, info.file_size, _Member(handle))
+        finally:
+          handle.close()
+    return
+
+  with open(path, 'rb') as handle:
+    if path.lower().endswith(('.tar.zst', '.tzst')):
+      stream = _open_zstd(handle)
+    else:
+      stream = handle
+
+    # Stream mode, so that compressed archives are only read once, in order
+    archive = tarfile.open(fileobj = stream, mode = 'r|*')
+
+    try:
+      for member in archive:
+        if not member.isfile():
+          continue
+        if not verifier.is_mp3(member.name, is_file = True):
+          continue
+
+        yield (member.name, member.size, _Member(archive.extractfile(member)))
+    finally:
+      archive.close()
+
+def verify_archive(path, options, progress=None):
+  """
+  Verifies the MP3 files in an archive as configured by the command-line
+  options (see verifier.verify_mp3_stream()).
+
+  @param str path
+    The path to the archive.
+
+  @param argparse.Namespace options
+    The parsed command-line options.
+
+  @param callable progress
+    (optional) See verifier.verify_file().
+
+  @return generator
+    VerificationResult instances, one per member, in the order they're
+    stored. If the archive can't be read (or stops being readable part way
+    through), an unsupported result for the archive itself follows.
+  """
+  try:
+    for name, size, handle in iter_members(path):
+      yield verifier.verify_mp3_stream(
+        handle, os.path.join(path, name.lstrip('/')), options, size, progress
+      )
+  except _get_errors() as e:
+    result = verifier.VerificationResult(path, verifier.ERROR_UNSUPPORTED)
+    result.debug('Failed to read archive: %s', e)
+    yield result
+
+def _verify_all(task):
+  return list(verify_archive(*task))
+
+def run(paths, options):
+  """
+  Verifies the MP3 files in archives, in parallel.
+
+  Each archive is read by one worker from start to end, so archives are
+  only verified side by side when there are several of them; a single
+  archive is verified in this process, with its results yielded as they
+  come.
+
+  @param list paths
+    The paths to the archives.
+
+  @param argparse.Namespace options
+    The parsed command-line options. If options.ordered is set, results are
+    yielded in the same order as paths.
+
+  @return generator
+    VerificationResult instances.
+  """
+  tasks = [(path, options) for path in paths]
+
+  if options.workers <= 1 or len(tasks) < 2:
+    for task in tasks:
+      for result in verify_archive(*task):
+        yield result
+    return
+
+  pool = engine.create_pool(options)
+
+  try:
+    imap = pool.imap if options.ordered else pool.imap_unordered
+
+    for results in imap(_verify_all, tasks, 1):
+      for result in results:
+        yield result
+
+    pool.close()
+    pool.join()
+  finally:
+    pool.terminate()
@@ -4,11 +4,15 @@
 Command-line argument and configuration handling.
 """
 
+import os
 import sys
 import argparse
-import multiprocessing
 
+from mp3sum import engine
 from mp3sum import logging
+from mp3sum import readers
+from mp3sum import util
+from mp3sum import verifier
 
 def init_args():
   """
@@ -19,7 +23,10 @@ def init_args():
   p = argparse.ArgumentParser(
     prog            = __import__('mp3sum').__name__,
     description     = __import__('mp3sum').__description__.rstrip('.') + '.',
-    usage           = '%(prog)s [options] path ...',
+    usage           = '%(prog)s [options] path ...\n'
+                      '       %(prog)s merge [options] file ...\n'
+                      '       %(prog)s manifest create [options] file path ...\n'
+                      '       %(prog)s manifest check [options] file',
     add_help        = True,
     formatter_class = lambda prog: argparse.HelpFormatter(
       # This increases the max width of the arguments column
@@ -27,17 +34,44 @@ def init_args():
     )
   )
   p.set_defaults(
-    absolute  = False,
-    basename  = False,
-    batch     = False,
-    colour    = None,
-    log_level = None,
-    recursive = False,
-    show_fail = None,
-    show_pass = True,
-    show_skip = None,
-    verbosity = [0],
-    workers   = None
+    absolute       = False,
+    basename       = False,
+    batch          = False,
+    cache          = None,
+    checkpoint     = None,
+    chunksize      = None,
+    colour         = None,
+    command        = None,
+    connect        = None,
+    device_workers = None,
+    digest         = None,
+    direct         = False,
+    drop_cache     = False,
+    format         = 'text',
+    log_level      = None,
+    mmap           = False,
+    ordered        = False,
+    output_db      = None,
+    profile        = False,
+    profile_out    = None,
+    progress       = False,
+    quick          = False,
+    read_size      = None,
+    recursive      = False,
+    rehash         = False,
+    resume         = False,
+    serve          = None,
+    shard          = None,
+    show_fail      = None,
+    show_pass      = True,
+    show_skip      = None,
+    split_size     = None,
+    stat_only      = False,
+    tail_size      = None,
+    verbosity      = [0],
+    watch          = False,
+    watch_poll     = None,
+    workers        = None
   )
   p.add_argument('-V', '--version',
     action  = 'version',
@@ -71,6 +105,33 @@ def init_args():
     action = 'store_true',
     help   = 'configure output for batch scripting'
   )
+  p.add_argument('--cache',
+    dest    = 'cache',
+    help    = 'set path to result cache file',
+    metavar = 'file'
+  )
+  p.add_argument('--no-cache',
+    dest   = 'cache',
+    action = 'store_const',
+    const  = False,
+    help   = 'neither read nor update the result cache'
+  )
+  p.add_argument('--checkpoint',
+    dest    = 'checkpoint',
+    help    = 'record results in a file as the run goes',
+    metavar = 'file'
+  )
+  p.add_argument('--chunksize',
+    dest    = 'chunksize',
+    type    = int,
+    help    = 'set maximum number of files per worker batch',
+    metavar = 'num'
+  )
+  p.add_argument('--connect',
+    dest    = 'connect',
+    help    = 'send files to the server listening on a socket',
+    metavar = 'socket'
+  )
   p.add_argument('--colour',
     dest   = 'colour',
     action = 'store_true',
@@ -96,6 +157,36 @@ def init_args():
     action = 'store_false',
     help   = argparse.SUPPRESS
   )
+  p.add_argument('--device-workers',
+    dest    = 'device_workers',
+    type    = int,
+    help    = 'set number of batches read at once per device (0 for no limit)',
+    metavar = 'num'
+  )
+  p.add_argument('--digest',
+    dest    = 'digest',
+    choices = util.DIGESTS,
+    help    = 'also compute a digest of each audio stream (%s)' % (
+      ', '.join(util.DIGESTS)
+    ),
+    metavar = 'name'
+  )
+  p.add_argument('--direct',
+    dest   = 'direct',
+    action = 'store_true',
+    help   = 'read files with O_DIRECT, bypassing the page cache'
+  )
+  p.add_argument('--drop-cache',
+    dest   = 'drop_cache',
+    action = 'store_true',
+    help   = 'drop files from the page cache once they\'ve been read'
+  )
+  p.add_argument('--format',
+    dest    = 'format',
+    choices = ('text', 'jsonl'),
+    help    = 'set result output format (text or jsonl)',
+    metavar = 'format'
+  )
   p.add_argument('-f', '--only-fail',
     dest   = 'show_fail',
     action = 'store_true',
@@ -110,6 +201,47 @@ def init_args():
     dest   = 'log_level',
     help   = argparse.SUPPRESS
   )
+  p.add_argument('--mmap',
+    dest   = 'mmap',
+    action = 'store_true',
+    help   = 'read files through memory maps'
+  )
+  p.add_argument('-o', '--ordered',
+    dest   = 'ordered',
+    action = 'store_true',
+    help   = 'show results in path order'
+  )
+  p.add_argument('--output-db',
+    dest    = 'output_db',
+    help    = 'also write results to an SQLite database',
+    metavar = 'file'
+  )
+  p.add_argument('--profile',
+    dest   = 'profile',
+    action = 'store_true',
+    help   = 'show a breakdown of where the time went'
+  )
+  p.add_argument('--profile-out',
+    dest    = 'profile_out',
+    help    = 'write each worker\'s cProfile statistics to file.PID',
+    metavar = 'file'
+  )
+  p.add_argument('--progress',
+    dest   = 'progress',
+    action = 'store_true',
+    help   = 'report progress on stderr'
+  )
+  p.add_argument('--quick',
+    dest   = 'quick',
+    action = 'store_true',
+    help   = 'check info tag CRCs only, skipping the audio stream'
+  )
+  p.add_argument('--read-size',
+    dest    = 'read_size',
+    type    = util.parse_size,
+    help    = 'set maximum number of bytes to read at once',
+    metavar = 'size'
+  )
   p.add_argument('-r', '--recursive',
     dest   = 'recursive',
     action = 'store_true',
@@ -120,6 +252,44 @@ def init_args():
     action = 'store_true',
     help   = argparse.SUPPRESS
   )
+  p.add_argument('--rehash',
+    dest   = 'rehash',
+    action = 'store_true',
+    help   = 'verify files even if their cached results are current'
+  )
+  p.add_argument('--resume',
+    dest   = 'resume',
+    action = 'store_true',
+    help   = 'skip files already recorded by --checkpoint'
+  )
+  p.add_argument('--serve',
+    dest    = 'serve',
+    help    = 'serve verification requests on a socket',
+    metavar = 'socket'
+  )
+  p.add_argument('--shard',
+    dest    = 'shard',
+    type    = util.parse_shard,
+    help    = 'verify only shard K of N (e.g., 2/4) of the files found',
+    metavar = 'K/N'
+  )
+  p.add_argument('--split-size',
+    dest    = 'split_size',
+    type    = util.parse_size,
+    help    = 'check-sum audio streams larger than this across all workers',
+    metavar = 'size'
+  )
+  p.add_argument('--stat-only',
+    dest   = 'stat_only',
+    action = 'store_true',
+    help   = 'with manifest check, pass files whose size and mtime match'
+  )
+  p.add_argument('--tail-size',
+    dest    = 'tail_size',
+    type    = util.parse_size,
+    help    = 'hold back this much of a stream for its trailing tags',
+    metavar = 'size'
+  )
   p.add_argument('-u', '--only-unsupported',
     dest   = 'show_skip',
     action = 'store_true',
@@ -130,6 +300,17 @@ def init_args():
     action = 'store_true',
     help   = argparse.SUPPRESS
   )
+  p.add_argument('--watch',
+    dest   = 'watch',
+    action = 'store_true',
+    help   = 'verify files as they are written to the paths, until interrupted'
+  )
+  p.add_argument('--watch-poll',
+    dest    = 'watch_poll',
+    type    = float,
+    help    = 'with --watch, scan for changes this often instead of using inotify',
+    metavar = 'secs'
+  )
   p.add_argument('--workers',
     dest    = 'workers',
     type    = int,
@@ -138,12 +319,48 @@ def init_args():
   )
   p.add_argument('path',
     nargs   = '*',
-    help    = 'file(s) or folder(s) to verify',
+    help    = 'file(s) or folder(s) to verify, or - for standard input (or, '
+              'with merge, result files; with manifest, the manifest file '
+              'first)',
     metavar = 'path ...'
   )
 
   return p
 
+def get_command(args):
+  """
+  Gets the sub-command at the start of a list of arguments, if any.
+
+  @param list args
+    The command-line arguments, or the positional arguments among them.
+
+  @return str|None
+    'merge', 'manifest create' or 'manifest check', or None if the arguments
+    don't start with a sub-command (i.e., files are to be verified).
+  """
+  if args[:1] == ['merge']:
+    return 'merge'
+  if args[:1] == ['manifest'] and args[1:2] in (['create'], ['check']):
+    return ' '.join(args[:2])
+  return None
+
+def get_cpu_count():
+  """
+  Gets the number of CPUs, without importing multiprocessing where possible.
+
+  @return int
+  """
+  try:
+    return os.cpu_count() or 1
+  except AttributeError:
+    pass
+
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except:
+    return 1
+
 def parse_args(args, parser):
   """
   Parses command-line arguments.
@@ -155,12 +372,84 @@ def parse_args(args, parser):
     An ArgumentParser instance.
 
   @return list
-    The parsed and normalised arguments.
+    The parsed and normalised arguments. options.command is the sub-command
+    (see get_command()), which isn't included in options.path.
   """
-  options = parser.parse_args(args)
+  # A sub-command may come before or after the options
+  command = get_command(args)
+  args    = args[len(command.split()):] if command else args
+
+  # Positional arguments after the first options are left over, rather than
+  # taken as paths (parse_intermixed_args() isn't available everywhere)
+  options, extra = parser.parse_known_args(args)
+
+  for arg in extra:
+    if arg.startswith('-') and arg != '-':
+      parser.error('unrecognized arguments: %s' % ' '.join(extra))
+
+  options.path += extra
+
+  if command is None:
+    command = get_command(options.path)
+
+    if command is not None:
+      options.path = options.path[len(command.split()):]
+
+  options.command = command
 
   options.verbosity    = sum(options.verbosity)
 
+  if options.read_size is None:
+    options.read_size = util.READ_SIZE
+  elif options.read_size < 1:
+    parser.error('argument --read-size: must be greater than 0')
+
+  if options.split_size is None:
+    options.split_size = engine.SPLIT_SIZE
+  elif options.split_size < 0:
+    parser.error('argument --split-size: must not be negative')
+
+  if options.tail_size is None:
+    options.tail_size = readers.TAIL_SIZE
+  elif options.tail_size < verifier.END_TAG_READ_SIZE:
+    parser.error(
+      'argument --tail-size: must be at least %d' % verifier.END_TAG_READ_SIZE
+    )
+
+  if '-' in options.path:
+    if options.path.count('-') > 1:
+      parser.error('argument path: standard input may only be given once')
+    if options.watch or options.serve is not None or options.connect is not None:
+      parser.error(
+        'argument path: standard input not allowed with --watch, --serve or '
+        '--connect'
+      )
+
+  if options.chunksize is not None and options.chunksize < 1:
+    parser.error('argument --chunksize: must be greater than 0')
+
+  if options.device_workers is not None and options.device_workers < 0:
+    parser.error('argument --device-workers: must not be negative')
+
+  if options.digest is not None:
+    try:
+      util.new_digest(options.digest)
+    except ValueError as e:
+      parser.error('argument --digest: %s' % e)
+
+  if options.watch_poll is not None and options.watch_poll <= 0:
+    parser.error('argument --watch-poll: must be greater than 0')
+
+  if options.watch and (options.serve is not None or options.connect is not None):
+    parser.error('argument --watch: not allowed with --serve or --connect')
+
+  if options.resume and options.checkpoint is None:
+    parser.error('argument --resume: requires --checkpoint')
+
+  # Quick runs don't find audio streams, so there'd be nothing to record
+  if options.quick and options.command == 'manifest create':
+    parser.error('argument --quick: not allowed with manifest create')
+
   if options.batch:
     options.colour    = False
     options.verbosity = 0
@@ -192,9 +481,6 @@ def parse_args(args, parser):
     options.workers = 1
   # Otherwise, try to auto-detect worker threads
   elif options.workers == None:
-    try:
-      options.workers = multiprocessing.cpu_count()
-    except:
-      options.workers = 1
+    options.workers = get_cpu_count()
 
   return options
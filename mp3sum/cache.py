@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent verification-result cache.
+"""
+
+import os
+import sqlite3
+
+"""
+The cache schema version. Bump this whenever the table layout changes; caches
+written with a different version are discarded.
+"""
+SCHEMA_VERSION = 3
+
+"""
+The number of queued results that triggers a commit.
+"""
+COMMIT_INTERVAL = 1000
+
+_schema = '''
+  CREATE TABLE IF NOT EXISTS results (
+    path          TEXT PRIMARY KEY,
+    device        INTEGER NOT NULL,
+    inode         INTEGER NOT NULL,
+    size          INTEGER NOT NULL,
+    mtime_ns      INTEGER NOT NULL,
+    result        INTEGER NOT NULL,
+    tag_crc_now   INTEGER NOT NULL,
+    tag_crc       INTEGER NOT NULL,
+    music_crc_now INTEGER NOT NULL,
+    music_crc     INTEGER NOT NULL,
+    digest        TEXT,
+    audio_start   INTEGER,
+    audio_end     INTEGER
+  )
+'''
+
+def default_path():
+  """
+  Gets the default cache-file path.
+
+  @return str
+    The path to the cache file, under $XDG_CACHE_HOME (or ~/.cache).
+  """
+  root = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+    os.path.expanduser('~'), '.cache'
+  )
+  return os.path.join(root, __import__('mp3sum').__name__, 'cache.sqlite')
+
+def get_signature(path, stat=None):
+  """
+  Gets the stat signature used to decide whether a file has changed.
+
+  @param str path
+    The path to the file.
+
+  @param os.stat_result stat
+    (optional) The result of a previous stat() call on the file.
+
+  @return tuple
+    The file's device, inode, size, and modification time in nanoseconds.
+  """
+  if stat is None:
+    stat = os.stat(path)
+
+  try:
+    mtime_ns = stat.st_mtime_ns
+  except AttributeError:
+    mtime_ns = int(stat.st_mtime * 1000000000)
+
+  return (stat.st_dev, stat.st_ino, stat.st_size, mtime_ns)
+
+class Cache(object):
+  """
+  Stores verification results keyed by absolute path and stat signature.
+  """
+  path = None
+
+  def __init__(self, path=None):
+    self.path = path if path else default_path()
+
+    directory = os.path.dirname(self.path)
+
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    self._db = sqlite3.connect(self.path)
+    self._pending = []
+
+    version = self._db.execute('PRAGMA user_version').fetchone()[0]
+
+    if version != SCHEMA_VERSION:
+      self._db.execute('DROP TABLE IF EXISTS results')
+      self._db.execute('PRAGMA user_version = %i' % SCHEMA_VERSION)
+
+    self._db.execute(_schema)
+    self._db.commit()
+
+  def get(self, path, signature, digest=None):
+    """
+    Looks up a cached result.
+
+    @param str path
+      The path to the file.
+
+    @param tuple signature
+      The file's current stat signature (see get_signature()).
+
+    @param str digest
+      (optional) The name of a digest that the result must include.
+
+    @return tuple|None
+      The cached result code, CRC tuple, digest, and audio-stream start and
+      end offsets (any of the last three may be None), or None if there is
+      no result for this path, the file has changed since it was stored, or
+      the result doesn't include the digest asked for.
+    """
+    row = self._db.execute(
+      '''
+        SELECT
+          result, tag_crc_now, tag_crc, music_crc_now, music_crc, digest,
+          audio_start, audio_end
+        FROM results
+        WHERE path = ? AND device = ? AND inode = ? AND size = ?
+          AND mtime_ns = ?
+      ''',
+      (os.path.abspath(path),) + tuple(signature)
+    ).fetchone()
+
+    if row is None:
+      return None
+
+    if digest and not (row[5] or '').startswith(digest + ':'):
+      return None
+
+    return (row[0], tuple(row[1:5])) + tuple(row[5:])
+
+  def put(
+    self,
+    path,
+    signature,
+    result,
+    crcs,
+    digest      = None,
+    audio_start = None,
+    audio_end   = None
+  ):
+    """
+    Queues a result to be stored. Results are written in batches; see
+    commit().
+
+    @param str path
+      The path to the file.
+
+    @param tuple signature
+      The file's stat signature as of before it was verified.
+
+    @param int result
+      The verifier result code.
+
+    @param tuple crcs
+      The computed and expected tag and music CRCs.
+
+    @param str digest
+      (optional) The audio stream's digest (see VerificationResult).
+
+    @param int audio_start
+      (optional) The offset of the start of the audio stream.
+
+    @param int audio_end
+      (optional) The offset of the end of the audio stream.
+    """
+    self._pending.append(
+      (os.path.abspath(path),) + tuple(signature) + (result,) + tuple(crcs)
+      + (digest, audio_start, audio_end)
+    )
+
+    if len(self._pending) >= COMMIT_INTERVAL:
+      self.commit()
+
+    return self
+
+  def commit(self):
+    """
+    Writes all queued results to the cache in a single transaction.
+    """
+    if self._pending:
+      with self._db:
+        self._db.executemany(
+          'INSERT OR REPLACE INTO results VALUES (%s)' % ', '.join('?' * 13),
+          self._pending
+        )
+      self._pending = []
+    return self
+
+  def close(self):
+    """
+    Commits any queued results and closes the cache.
+    """
+    self.commit()
+    self._db.close()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""
+File discovery.
+"""
+
+import os
+import zlib
+
+from mp3sum import verifier
+
+def _scan(path):
+  """
+  Lists a directory's entries in name order.
+
+  @param str path
+    The path to the directory.
+
+  @return list
+    A list of (name, path, is_dir, is_file) tuples. Type information comes
+    from the directory entries themselves where the platform supports it.
+  """
+  entries = []
+
+  if hasattr(os, 'scandir'):
+    for entry in os.scandir(path):
+      try:
+        is_dir  = entry.is_dir(follow_symlinks = False)
+        is_file = not is_dir and entry.is_file()
+      except OSError:
+        continue
+      entries.append((entry.name, entry.path, is_dir, is_file))
+  else:
+    for name in os.listdir(path):
+      sub_path = os.path.join(path, name)
+      is_dir   = os.path.isdir(sub_path) and not os.path.islink(sub_path)
+      is_file  = not is_dir and os.path.isfile(sub_path)
+      entries.append((name, sub_path, is_dir, is_file))
+
+  entries.sort()
+  return entries
+
+def get_shard(key, count):
+  """
+  Assigns a file to a shard.
+
+  @param str key
+    The file's path relative to the directory it was found under (or its
+    name, if it was supplied directly), so that hosts with the same files
+    mounted in different places agree.
+
+  @param int count
+    The number of shards.
+
+  @return int
+    The shard's index (counting from 0).
+  """
+  key = key.replace(os.sep, '/')
+
+  if not isinstance(key, bytes):
+    key = key.encode('utf-8', 'surrogateescape')
+
+  return (zlib.crc32(key) & 0xffffffff) % count
+
+def find_mp3s(paths, recursive=False, onerror=None, shard=None):
+  """
+  Lazily finds the MP3 files to verify.
+
+  Directories are read one at a time as the caller consumes the results, so
+  verification can begin as soon as the first file has been found.
+
+  @param iterable paths
+    The file and directory paths supplied by the user. Files are yielded as
+    they are, whether they look like MP3s or not.
+
+  @param bool recursive
+    (optional) Whether to descend into sub-directories.
+
+  @param callable onerror
+    (optional) A function to call with the OSError raised when a directory
+    can't be read. Unreadable directories are skipped.
+
+  @param tuple shard
+    (optional) The index (counting from 0) and count of the shard to find
+    files for (see get_shard()). Files assigned to other shards are skipped.
+
+  @return generator
+    The paths of the files to verify, in sorted order per directory.
+  """
+  for path in paths:
+    if not os.path.isdir(path):
+      if shard is None or get_shard(os.path.basename(path), shard[1]) == shard[0]:
+        yield path
+      continue
+
+    prefix = len(os.path.join(path, ''))
+
+    # Files in a directory come before the contents of its sub-directories,
+    # as with os.walk()
+    stack = [path]
+
+    while stack:
+      directory = stack.pop()
+
+      try:
+        entries = _scan(directory)
+      except OSError as e:
+        if onerror is not None:
+          onerror(e)
+        continue
+
+      sub_dirs = []
+
+      for name, sub_path, is_dir, is_file in entries:
+        if is_dir:
+          sub_dirs.append(sub_path)
+        elif not is_file:
+          continue
+        elif shard is not None and get_shard(sub_path[prefix:], shard[1]) != shard[0]:
+          continue
+        elif verifier.is_mp3(sub_path, name = name, is_file = True):
+          yield sub_path
+
+      if recursive:
+        stack.extend(reversed(sub_dirs))
@@ -0,0 +1,777 @@
+# -*- coding: utf-8 -*-
+
+"""
+Parallel verification engine.
+"""
+
+import copy
+import heapq
+import itertools
+import os
+import signal
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+from mp3sum import cache
+from mp3sum import readers
+from mp3sum import util
+from mp3sum import verifier
+
+"""
+The number of files per worker that may be in flight (queued, being verified,
+or waiting in the reorder buffer) before file discovery pauses.
+"""
+MAX_PENDING_PER_WORKER = 64
+
+"""
+The default maximum number of files sent to a worker in one batch.
+"""
+BATCH_FILES = 16
+
+"""
+The total file size at which a batch is sent without waiting for more files.
+Small files are grouped to amortise the cost of dispatching them; large files
+are sent on their own so the work stays evenly spread across the workers.
+"""
+BATCH_BYTES = 4 * 1024 * 1024
+
+"""
+The default audio-stream length above which a file's music CRC is computed
+in segments across all of the workers.
+"""
+SPLIT_SIZE = 64 * 1024 * 1024
+
+"""
+The default number of batches that may be in flight at once per rotational
+device. Reads from any more than this make the disk seek back and forth
+between files, which costs more than the extra workers gain.
+"""
+ROTATIONAL_WORKERS = 1
+
+"""
+The number of files below which a run is verified in the calling process,
+rather than paying to start a pool of workers.
+"""
+INLINE_FILES = 4
+
+# The options for the current worker process; see _init_worker()
+_options = None
+
+# The current worker process's profiler, if it's profiling; see _init_worker()
+_profiler = None
+
+# The current worker process's shared counter of bytes check-summed, if
+# progress is being reported; see _init_worker()
+_counter = None
+
+def _iter_queue(tasks):
+  """
+  Yields tasks from a queue until a None sentinel is received.
+
+  This is consumed by the pool's task-handler thread, so the parent can keep
+  adding work after the pool has started.
+  """
+  while True:
+    task = tasks.get()
+    if task is None:
+      return
+    yield task
+
+def _init_worker(options, counter=None):
+  """
+  Initialises a worker process.
+
+  The options are sent once per worker here rather than with every task.
+  Interrupts are left to the parent, which stops the workers itself.
+
+  @param argparse.Namespace options
+    The parsed command-line options.
+
+  @param multiprocessing.Value counter
+    (optional) A shared counter to add the number of bytes check-summed to.
+  """
+  global _options, _counter, _profiler
+  _options = options
+  _counter = counter
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+  if options.profile_out:
+    import cProfile
+    from multiprocessing import util as mp_util
+
+    _profiler = cProfile.Profile()
+
+    # Run as the worker exits after the pool's closed (but not if it's
+    # terminated), so that the statistics are written once per worker
+    mp_util.Finalize(
+      None,
+      _dump_profile,
+      args         = (_profiler, options.profile_out),
+      exitpriority = 10
+    )
+
+def _dump_profile(profiler, path):
+  """
+  Writes a profiler's statistics to a file of the current process's own,
+  path.PID, so that workers don't overwrite one another's.
+
+  @param cProfile.Profile profiler
+    The profiler whose statistics to write.
+
+  @param str path
+    The path given with --profile-out.
+  """
+  profiler.create_stats()
+
+  # A worker that was never given anything to do has nothing to write, and
+  # pstats can't read an empty file
+  if profiler.stats:
+    profiler.dump_stats('%s.%d' % (path, os.getpid()))
+
+def get_worker_options():
+  """
+  Gets the options the current worker process was started with, so that
+  tasks run by a pool from create_pool() needn't carry their own copies.
+
+  @return argparse.Namespace|None
+    The options, or None outside of a worker process.
+  """
+  return _options
+
+def _get_count(counter):
+  """
+  Gets a function that adds to a shared count of bytes check-summed.
+
+  @param multiprocessing.Value counter
+    The shared counter, or None.
+
+  @return callable|None
+    The function, or None if there's no counter.
+  """
+  if counter is None:
+    return None
+
+  def count(length):
+    with counter.get_lock():
+      counter.value += length
+
+  return count
+
+class _InlinePool(object):
+  """
+  Stands in for a multiprocessing.Pool, running tasks in the calling process
+  as their results are asked for.
+
+  The options are kept here rather than in the module's globals (which are
+  only for worker processes), so that runs in the same process, such as
+  library callers', don't change one another's options part way through.
+  """
+  def __init__(self, options, counter=None):
+    self.options         = copy.copy(options)
+    self.options.workers = 1
+    self.counter         = counter
+    self.profiler        = None
+
+    if options.profile_out:
+      import cProfile
+      self.profiler = cProfile.Profile()
+
+  def imap_unordered(self, func, iterable):
+    """
+    Runs tasks with func, which is given this pool's options and counter
+    too (see _run_batch()).
+    """
+    return (self._run(func, task) for task in iterable)
+
+  def _run(self, func, task):
+    if self.profiler is None:
+      return func(task, self.options, self.counter)
+
+    self.profiler.enable()
+
+    try:
+      return func(task, self.options, self.counter)
+    finally:
+      self.profiler.disable()
+
+  def close(self):
+    if self.profiler is not None:
+      _dump_profile(self.profiler, self.options.profile_out)
+      self.profiler = None
+
+  def join(self):
+    pass
+
+  def terminate(self):
+    pass
+
+def _is_small(paths, options):
+  """
+  Determines whether a run is too small to be worth starting workers for.
+
+  @param list paths
+    The first INLINE_FILES paths of the run (or all of them, if fewer).
+
+  @param argparse.Namespace options
+    The parsed command-line options.
+
+  @return bool
+  """
+  if options.workers <= 1:
+    return True
+  if len(paths) >= INLINE_FILES:
+    return False
+
+  # Big files are still worth splitting across the workers
+  if options.split_size:
+    for path in paths:
+      try:
+        if os.path.getsize(path) >= options.split_size:
+          return False
+      except OSError:
+        pass
+
+  return True
+
+def _crc_segment(path, segment, options, progress=None):
+  """
+  Computes the CRC-16 of part of a file.
+
+  @param str path
+    The path to the file.
+
+  @param tuple segment
+    The offset and length of the part to check-sum.
+
+  @param argparse.Namespace options
+    The parsed command-line options.
+
+  @param callable progress
+    (optional) A function to call with the number of bytes check-summed.
+
+  @return tuple
+    The CRC-16 (or None if the file couldn't be read) and a dict of the time
+    spent reading, check-summing, and in total.
+  """
+  offset, length = segment
+  timings        = {}
+  started        = util.clock()
+  crc            = None
+
+  try:
+    reader = readers.open_reader(
+      path, options.mmap, options.drop_cache, options.direct
+    )
+  except (IOError, OSError):
+    reader = None
+
+  if reader is not None:
+    try:
+      crc = reader.crc16(
+        offset,
+        length,
+        options.read_size,
+        timings,
+        progress
+      )
+    except (IOError, OSError):
+      pass
+    finally:
+      reader.close()
+
+  timings['total'] = util.clock() - started
+
+  return (crc, timings)
+
+def _run_tasks(batch, options, counter=None):
+  """
+  Runs a batch of tasks (see _run_batch()).
+  """
+  split_size = options.split_size if options.workers > 1 else None
+  progress   = _get_count(counter)
+  results    = []
+
+  for index, path, segment in batch:
+    if segment is None:
+      value = verifier.verify_mp3(path, options, split_size, progress)
+    else:
+      value = _crc_segment(path, segment, options, progress)
+    results.append((index, segment, value))
+
+  return results
+
+def _run_batch(batch, options=None, counter=None):
+  """
+  Runs a batch of tasks in a worker process (or, given options, in the
+  calling process; see _InlinePool).
+
+  If options.profile_out is set, the worker profiles its tasks; its
+  statistics are written when it exits (see _init_worker()).
+
+  @param list batch
+    A list of (index, path, segment) tuples. If segment is None, the file
+    is verified; otherwise it's an (offset, length) tuple giving a part of
+    the file's audio stream to check-sum.
+
+  @param argparse.Namespace options
+    (optional) The parsed command-line options. Defaults to the worker's
+    (see _init_worker()), as does counter.
+
+  @param multiprocessing.Value counter
+    (optional) A shared counter to add the number of bytes check-summed to.
+
+  @return list
+    A list of (index, segment, value) tuples, where value is the file's
+    VerificationResult or the segment's CRC-16 and timings (see
+    _crc_segment()).
+  """
+  if options is None:
+    options, counter = _options, _counter
+
+  # Only set in worker processes; the inline pool profiles its own tasks
+  if _profiler is None:
+    return _run_tasks(batch, options, counter)
+
+  _profiler.enable()
+
+  try:
+    return _run_tasks(batch, options, counter)
+  finally:
+    _profiler.disable()
+
+def _split(result, count):
+  """
+  Divides a result's audio stream into segments.
+
+  @param VerificationResult result
+    A result whose music CRC has been deferred.
+
+  @param int count
+    The number of segments to produce.
+
+  @return list
+    A list of (offset, length) tuples.
+  """
+  length = result.audio_end - result.audio_start
+  size   = -(-length // count)
+
+  return [
+    (offset, min(size, result.audio_end - offset))
+    for offset in range(result.audio_start, result.audio_end, size)
+  ]
+
+def _combine(result, parts):
+  """
+  Completes a deferred result from the CRCs of its audio-stream segments.
+
+  @param VerificationResult result
+    The deferred result.
+
+  @param dict parts
+    A dict mapping each segment's (offset, length) tuple to its CRC-16 and
+    timings.
+
+  @return VerificationResult
+    The completed result.
+  """
+  crc = 0
+
+  # The segments were check-summed side by side, so their times add up to
+  # more than the time taken
+  for part, timings in parts.values():
+    for stage, value in timings.items():
+      result.timings[stage] = result.timings.get(stage, 0.0) + value
+
+  for (offset, length), (part, timings) in sorted(parts.items()):
+    if part is None:
+      result.debug('Failed to parse audio stream')
+      result.result     = verifier.ERROR_MUSIC_MISMATCH
+      result.read_error = 'failed to read audio stream segment'
+      return result
+    crc = util.crc16_combine(crc, part, length)
+
+  result.music_crc_now = crc
+  result.result        = verifier.check_music_crc(
+    crc, result.music_crc, result.debug
+  )
+
+  return result
+
+class _Scheduler(object):
+  """
+  Hands tasks to the pool device by device.
+
+  Each device (by st_dev) has a cap on the number of batches it may have in
+  flight: ROTATIONAL_WORKERS for spinning disks and none for anything else,
+  unless options.device_workers says otherwise. Tasks over the cap wait
+  here, and each device's files are handed out in inode order, which on most
+  file systems is close to the order of their data on disk. Files on
+  different devices are still verified side by side.
+  """
+  def __init__(self, tasks, options):
+    """
+    @param queue.Queue tasks
+      The queue feeding the pool.
+
+    @param argparse.Namespace options
+      The parsed command-line options.
+    """
+    self.tasks     = tasks
+    self.options   = options
+    self.chunksize = options.chunksize or BATCH_FILES
+    self.caps      = {} # Batch caps, by device
+    self.queued    = {} # Heaps of waiting tasks, by device
+    self.sizes     = {} # Total size of waiting tasks, by device
+    self.busy      = {} # Batches in flight, by device
+    self.devices   = {} # Devices of files in flight, by index
+
+  def get_cap(self, device):
+    """
+    Gets the number of batches a device may have in flight.
+
+    @param int device
+      The device number, or None if it's unknown.
+
+    @return int|None
+      The cap, or None if the device is only limited by the pool size.
+    """
+    if device not in self.caps:
+      cap = None
+
+      if self.options.device_workers is not None:
+        cap = self.options.device_workers or None
+      elif device is not None and util.is_rotational(device):
+        cap = ROTATIONAL_WORKERS
+
+      self.caps[device] = cap
+
+    return self.caps[device]
+
+  def get_width(self, index):
+    """
+    Gets the number of segments to divide a file's audio stream into.
+
+    @param int index
+      The file's index.
+
+    @return int
+    """
+    cap = self.get_cap(self.devices.get(index))
+    return self.options.workers if cap is None else min(cap, self.options.workers)
+
+  def add(self, index, path, signature=None, segment=None):
+    """
+    Queues a file to verify or a segment to check-sum, sending it on with
+    any others if they make up a full batch and the device has room.
+
+    @param int index
+      The file's index.
+
+    @param str path
+      The path to the file.
+
+    @param tuple signature
+      (optional) The file's stat signature (see cache.get_signature()).
+
+    @param tuple segment
+      (optional) The offset and length of a segment of the file's audio
+      stream to check-sum. The file must have been added before.
+    """
+    if segment is None:
+      device, inode, size = signature[:3] if signature is not None else (None, 0, 0)
+      self.devices[index] = device
+      # Files are ordered by inode, after any segments
+      entry = (1, inode, index, path, None, size)
+    else:
+      device = self.devices[index]
+      # Segments are ordered by offset, so that files are finished in turn
+      entry  = (0, segment[0], index, path, segment, segment[1])
+
+    heapq.heappush(self.queued.setdefault(device, []), entry)
+    self.sizes[device] = self.sizes.get(device, 0) + entry[5]
+
+    self.send(device, partial = False)
+
+  def send(self, device, partial=True):
+    """
+    Sends a device's waiting tasks to the pool, as far as its cap allows.
+
+    @param int device
+      The device number.
+
+    @param bool partial
+      (optional) Whether to send a batch that isn't full.
+    """
+    queued = self.queued[device]
+    cap    = self.get_cap(device)
+
+    while queued and (cap is None or self.busy.get(device, 0) < cap):
+      full = (
+        queued[0][4] is not None
+        or len(queued) >= self.chunksize
+        or self.sizes[device] >= BATCH_BYTES
+      )
+
+      if not full and not partial:
+        return
+
+      batch = []
+      size  = 0
+
+      # Segments are sent on their own, so they're spread across the workers
+      while queued and len(batch) < self.chunksize and size < BATCH_BYTES:
+        if batch and queued[0][4] is not None:
+          break
+
+        entry = heapq.heappop(queued)
+        size += entry[5]
+        batch.append(entry[2:5])
+
+        if entry[4] is not None:
+          break
+
+      self.sizes[device] -= size
+      self.busy[device]   = self.busy.get(device, 0) + 1
+      self.tasks.put(batch)
+
+  def dispatch(self):
+    """
+    Sends all of the waiting tasks that the devices have room for, whether
+    they make up full batches or not.
+    """
+    for device in self.queued:
+      self.send(device)
+
+  def returned(self, index):
+    """
+    Records a batch returned by the pool.
+
+    @param int index
+      The index of any file in the batch.
+    """
+    self.busy[self.devices[index]] -= 1
+
+  def finished(self, index):
+    """
+    Forgets a file that's been verified.
+
+    @param int index
+      The file's index.
+    """
+    self.devices.pop(index, None)
+
+def create_pool(options, counter=None):
+  """
+  Creates a pool of worker processes.
+
+  @param argparse.Namespace options
+    The parsed command-line options. These are fixed for the life of the
+    pool.
+
+  @param multiprocessing.Value counter
+    (optional) A shared counter for the workers to add the number of bytes
+    check-summed to.
+
+  @return multiprocessing.Pool
+  """
+  import multiprocessing
+
+  return multiprocessing.Pool(
+    options.workers,
+    initializer = _init_worker,
+    initargs    = (options, counter)
+  )
+
+def run(paths, options, store=None, pool=None, progress=None):
+  """
+  Verifies files in parallel, yielding each result as it becomes available.
+
+  Only the calling process reads from the cache or reports results; the
+  workers just verify.
+
+  @param iterable paths
+    The paths of the files to verify. This is consumed lazily.
+
+  @param argparse.Namespace options
+    The parsed command-line options. If options.ordered is set, results are
+    yielded in the same order as paths; otherwise they're yielded in order
+    of completion.
+
+  @param Cache store
+    (optional) A result cache to consult and update.
+
+  @param multiprocessing.Pool pool
+    (optional) A pool created by create_pool() to run the files on. This is
+    left running afterwards, but it can only serve one run at a time. If
+    this is None, a pool is created for the run, unless the run is small
+    enough to verify in this process (see INLINE_FILES).
+
+  @param Progress progress
+    (optional) A progress.Progress instance to keep up to date. This is only
+    told about bytes as they're check-summed if the pool is created for the
+    run; otherwise, it's told about each file as it's finished.
+
+  @return generator
+    VerificationResult instances.
+  """
+  window     = options.workers * MAX_PENDING_PER_WORKER
+  tasks      = queue.Queue()
+  scheduler  = _Scheduler(tasks, options)
+  own_pool   = pool is None
+  counter    = progress.counter if progress is not None and own_pool else None
+
+  if own_pool:
+    paths = iter(paths)
+    head  = list(itertools.islice(paths, INLINE_FILES))
+    paths = itertools.chain(head, paths)
+    pool  = (
+      _InlinePool(options, counter) if _is_small(head, options)
+      else create_pool(options, counter)
+    )
+
+  source     = enumerate(paths)
+  results    = pool.imap_unordered(_run_batch, _iter_queue(tasks))
+
+  pending    = 0  # Submitted to the pool but not yet returned
+  reordered  = {} # Returned but waiting on an earlier result (ordered mode)
+  emitted    = 0  # Next index to yield (ordered mode)
+  signatures = {} # Stat signatures of submitted files, for the cache
+  splits     = {} # Deferred results and their segment CRCs, by index
+  sizes      = {} # File sizes, for progress reporting
+
+  try:
+    while True:
+      ready = []
+
+      # Top up the pool from discovery, serving unchanged files from the cache
+      while source is not None and pending + len(reordered) + len(ready) < window:
+        try:
+          index, path = next(source)
+        except StopIteration:
+          source = None
+
+          if progress is not None:
+            progress.discovered()
+          break
+
+        try:
+          signature = cache.get_signature(path)
+        except OSError:
+          signature = None
+
+        if progress is not None:
+          sizes[index] = signature[2] if signature is not None else 0
+          progress.found(sizes[index])
+
+        hit = None
+        if store is not None and signature is not None and not options.rehash:
+          hit = store.get(path, signature, options.digest)
+
+        if hit is not None:
+          result             = verifier.VerificationResult(path, hit[0], hit[1])
+          result.cached      = True
+          result.size        = signature[2]
+          result.digest      = hit[2]
+          result.audio_start = hit[3]
+          result.audio_end   = hit[4]
+          ready.append((index, result))
+          continue
+
+        # Keep the pre-verification signature until the result comes back,
+        # so a file modified mid-check is verified again next time
+        if store is not None and signature is not None:
+          signatures[index] = signature
+
+        scheduler.add(index, path, signature)
+        pending += 1
+
+      # Don't hold back partial batches while we wait on the pool
+      scheduler.dispatch()
+
+      if not ready:
+        if pending == 0:
+          break
+
+        returned = next(results)
+        scheduler.returned(returned[0][0])
+
+        for index, segment, result in returned:
+          pending -= 1
+
+          # Part of a large file's audio stream; the file is done once all
+          # of its segments are in
+          if segment is not None:
+            part                 = result
+            result, parts, count = splits[index]
+            parts[segment]       = part
+
+            if len(parts) < count:
+              continue
+
+            del splits[index]
+            result = _combine(result, parts)
+
+          # A large file whose music CRC was deferred; hand its segments out
+          # individually so that they're spread across the workers (or as
+          # many of them as its device allows)
+          elif result.result is None:
+            segments      = _split(result, scheduler.get_width(index))
+            splits[index] = (result, {}, len(segments))
+            pending      += len(segments)
+
+            for segment in segments:
+              scheduler.add(index, result.path, segment = segment)
+            continue
+
+          scheduler.finished(index)
+
+          if index in signatures:
+            result.signature = signatures.pop(index)
+            # Quick results would clobber any full results already cached,
+            # and a file that couldn't be read may be readable next time
+            if (
+              result.result not in (verifier.ERROR_NOT_MP3, verifier.ERROR_TAG_OK)
+              and result.read_error is None
+            ):
+              store.put(
+                result.path,
+                result.signature,
+                result.result,
+                result.crcs,
+                result.digest,
+                result.audio_start,
+                result.audio_end
+              )
+
+          ready.append((index, result))
+
+      for index, result in ready:
+        if progress is not None:
+          progress.finished(result, sizes.pop(index), counter is not None)
+
+        if not options.ordered:
+          yield result
+          continue
+
+        reordered[index] = result
+
+        while emitted in reordered:
+          yield reordered.pop(emitted)
+          emitted += 1
+
+    # Deferred files can add work right up until the last result, so the
+    # task handler is only told that we're done here
+    tasks.put(None)
+
+    if own_pool:
+      pool.close()
+      pool.join()
+  finally:
+    # Unblock the task handler in case we're bailing out early
+    tasks.put(None)
+
+    if own_pool:
+      pool.terminate()
@@ -7,7 +7,6 @@ Log/output handling.
 from __future__ import print_function
 
 import sys
-import colors
 
 CRITICAL = 50
 ERROR    = 40
@@ -86,7 +85,9 @@ class Logger(object):
 
     if prefix:
       message = '%s: %s' % (self.prefix, message)
-    if self.colour:
+    if self.colour and (fg or bg or style):
+      # Imported here so that runs without colour don't have to load it
+      import colors
       message = colors.color(message, fg = fg, bg = bg, style = style)
 
     print(message, end = end, file = file)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+"""
+Audio-stream manifests (mp3sum manifest create and mp3sum manifest check).
+
+A manifest is a text file listing, for each file with a recognisable audio
+stream, its size, modification time, audio-stream offsets, music CRC (0000
+for files that couldn't be verified) and digest, sorted by path:
+
+  # mp3sum manifest 1
+  # size mtime_ns audio_start audio_end crc digest path
+  81507 1697040000000000000 1259 81507 73CA blake2b:f58e... a/b.mp3
+
+Paths are recorded as given (so a manifest created in one directory can be
+checked against a copy of it from another), with backslashes and newlines
+escaped. Checking a file reads just its recorded audio stream, without
+looking for tags, unless its size has changed.
+"""
+
+import os
+import re
+
+from mp3sum import cache
+from mp3sum import engine
+from mp3sum import readers
+from mp3sum import util
+from mp3sum import verifier
+
+"""
+The manifest format version.
+"""
+VERSION = 1
+
+"""
+The digest used when creating a manifest, if none is asked for (the first of
+these that's available).
+"""
+DEFAULT_DIGESTS = ('blake2b', 'sha256')
+
+_header = (
+  '# mp3sum manifest %d\n'
+  '# size mtime_ns audio_start audio_end crc digest path\n'
+) % VERSION
+
+_unescape_re = re.compile(br'\\(.)')
+
+# Why each digest named by a manifest can't be computed here (or None, if it
+# can), by name; see _get_digest_error()
+_digest_errors = {}
+
+def get_default_digest():
+  """
+  Gets the digest to use when creating a manifest, if none is asked for.
+
+  @return str
+  """
+  for name in DEFAULT_DIGESTS:
+    try:
+      util.new_digest(name)
+      return name
+    except ValueError:
+      pass
+  return DEFAULT_DIGESTS[-1]
+
+def _get_digest_error(name):
+  """
+  Determines whether a digest can be computed, trying each name only once.
+
+  @return str|None
+    Why the digest isn't available, or None if it is.
+  """
+  if name not in _digest_errors:
+    try:
+      util.new_digest(name)
+      _digest_errors[name] = None
+    except ValueError as e:
+      _digest_errors[name] = str(e)
+
+  return _digest_errors[name]
+
+def _encode_path(path):
+  path = os.fsencode(path) if hasattr(os, 'fsencode') else path
+  return path.replace(b'\\', b'\\\\').replace(b'\n', b'\\n')
+
+def _decode_path(path):
+  path = _unescape_re.sub(
+    lambda match: b'\n' if match.group(1) == b'n' else match.group(1), path
+  )
+  return os.fsdecode(path) if hasattr(os, 'fsdecode') else path
+
+def read_manifest(path):
+  """
+  Reads the entries of a manifest.
+
+  @param str path
+    The path to the manifest.
+
+  @return generator
+    (path, size, mtime_ns, audio_start, audio_end, crc, digest) tuples.
+
+  @raise ValueError
+    If the file isn't a manifest this version can read.
+  """
+  with open(path, 'rb') as handle:
+    header = handle.readline()
+
+    if header.strip() != _header.splitlines()[0].encode('ascii'):
+      raise ValueError('not an mp3sum manifest (version %d): %s' % (VERSION, path))
+
+    for line in handle:
+      if line.startswith(b'#') or not line.strip():
+        continue
+
+      fields = line.rstrip(b'\n').split(b' ', 6)
+
+      if len(fields) != 7:
+        raise ValueError('malformed manifest line: %r' % line)
+
+      yield (
+        _decode_path(fields[6]),
+        int(fields[0]),
+        int(fields[1]),
+        int(fields[2]),
+        int(fields[3]),
+        int(fields[4], 16),
+        fields[5].decode('ascii'),
+      )
+
+class ManifestSink(object):
+  """
+  Collects results into a manifest, which is written (sorted, and all at
+  once) when the sink is closed. Results without a digest are left out.
+  """
+  path = None
+
+  def __init__(self, path):
+    """
+    @param str path
+      The path to write the manifest to. It's replaced atomically.
+    """
+    self.path    = path
+    self.entries = []
+
+  def write(self, result):
+    if result.digest is None or result.audio_end is None:
+      return self
+
+    try:
+      mtime_ns = (result.signature or cache.get_signature(result.path))[3]
+    except OSError:
+      return self
+
+    self.entries.append((
+      _encode_path(result.path),
+      result.size,
+      mtime_ns,
+      result.audio_start,
+      result.audio_end,
+      result.music_crc_now,
+      result.digest,
+    ))
+    return self
+
+  def close(self):
+    """
+    Writes the manifest.
+    """
+    temp = '%s.%d.tmp' % (self.path, os.getpid())
+
+    with open(temp, 'wb') as handle:
+      handle.write(_header.encode('ascii'))
+
+      for entry in sorted(self.entries):
+        handle.write(('%d %d %d %d %04X %s ' % entry[1:]).encode('ascii'))
+        handle.write(entry[0] + b'\n')
+
+    os.rename(temp, self.path)
+
+def check_entry(entry, options):
+  """
+  Checks a file against its manifest entry.
+
+  If the file's size hasn't changed, only its recorded audio stream is read;
+  otherwise (or if that doesn't match), the file is verified as usual to
+  find its audio stream again, so that re-tagged files still pass.
+
+  @param tuple entry
+    The manifest entry (see read_manifest()).
+
+  @param argparse.Namespace options
+    The parsed command-line options. If options.stat_only is set, files
+    whose size and modification time are unchanged pass without being read.
+
+  @return VerificationResult
+    A result with the recorded music CRC as the expected one. Missing and
+    changed files are reported as music CRC mismatches, and files whose
+    digest can't be computed here as unsupported.
+  """
+  path, size, mtime_ns, audio_start, audio_end, crc, digest = entry
+
+  name    = digest.split(':', 1)[0]
+  result  = verifier.VerificationResult(path, None, (0, 0, 0, crc))
+  started = util.clock()
+
+  try:
+    signature = cache.get_signature(path)
+  except OSError as e:
+    result.debug('Failed to read file: %s', e)
+    result.result = verifier.ERROR_MUSIC_MISMATCH
+    return result
+
+  result.size = signature[2]
+
+  if options.stat_only and signature[2:4] == (size, mtime_ns):
+    result.debug('Unchanged since the manifest was created')
+    result.result        = verifier.ERROR_OK
+    result.cached        = True
+    result.music_crc_now = crc
+    result.digest        = digest
+    result.audio_start   = audio_start
+    result.audio_end     = audio_end
+    return result
+
+  # A manifest created elsewhere may name a digest that isn't available here
+  error = _get_digest_error(name)
+
+  if error is not None:
+    result.debug('Cannot compute digest: %s', error)
+    result.result = verifier.ERROR_UNSUPPORTED
+    return result
+
+  if signature[2] == size:
+    hasher = util.new_digest(name)
+    reader = None
+
+    try:
+      reader = readers.open_reader(
+        path, options.mmap, options.drop_cache, options.direct
+      )
+      reader.crc16(
+        audio_start,
+        audio_end - audio_start,
+        options.read_size,
+        result.timings,
+        None,
+        hasher
+      )
+      result.digest = '%s:%s' % (name, hasher.hexdigest())
+    except (IOError, OSError) as e:
+      result.debug('Failed to read file: %s', e)
+    finally:
+      if reader is not None:
+        reader.close()
+
+    # The same audio stream, so the same music CRC
+    if result.digest == digest:
+      result.result           = verifier.ERROR_OK
+      result.music_crc_now    = crc
+      result.audio_start      = audio_start
+      result.audio_end        = audio_end
+      result.timings['total'] = util.clock() - started
+      return result
+
+    result.debug('Recorded audio stream has changed; looking for it again')
+
+  found = verifier.verify_file(
+    path,
+    read_size  = options.read_size,
+    use_mmap   = options.mmap,
+    drop_cache = options.drop_cache,
+    direct     = options.direct,
+    digest     = name
+  )
+
+  result.messages.extend(found.messages)
+  result.music_crc_now = found.music_crc_now
+  result.digest        = found.digest
+  result.audio_start   = found.audio_start
+  result.audio_end     = found.audio_end
+
+  if found.digest == digest:
+    result.result = verifier.ERROR_OK
+  else:
+    result.debug(
+      'Digest mismatch: computed %s, expected %s', found.digest, digest
+    )
+    result.result = verifier.ERROR_MUSIC_MISMATCH
+
+  for stage, value in found.timings.items():
+    result.timings[stage] = result.timings.get(stage, 0.0) + value
+
+  result.timings['total'] = util.clock() - started
+  return result
+
+def _check(entry):
+  # The options are sent to the workers once, by create_pool()
+  return check_entry(entry, engine.get_worker_options())
+
+def _run(entries, options):
+  if options.workers <= 1 or len(entries) < engine.INLINE_FILES:
+    for entry in entries:
+      yield check_entry(entry, options)
+    return
+
+  pool = engine.create_pool(options)
+
+  try:
+    chunksize = options.chunksize or engine.BATCH_FILES
+    imap      = pool.imap if options.ordered else pool.imap_unordered
+
+    for result in imap(_check, entries, chunksize):
+      yield result
+
+    pool.close()
+    pool.join()
+  finally:
+    pool.terminate()
+
+def check(path, options):
+  """
+  Checks files against a manifest, in parallel.
+
+  @param str path
+    The path to the manifest.
+
+  @param argparse.Namespace options
+    The parsed command-line options. Results are yielded in manifest order
+    if options.ordered is set.
+
+  @return generator
+    VerificationResult instances.
+
+  @raise ValueError
+    If the manifest can't be read (see read_manifest()). This is raised
+    before any files are checked.
+  """
+  return _run(list(read_manifest(path)), options)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run-time profiling (--profile).
+"""
+
+import math
+import sys
+
+from mp3sum import util
+
+"""
+The stages reported on, in order. 'walk' is the time spent finding files;
+the rest are recorded by the verifier (see VerificationResult).
+"""
+STAGES = ('walk', 'open', 'header', 'tail', 'read', 'crc', 'total')
+
+def percentile(values, fraction):
+  """
+  Gets a percentile of a list of values (by the nearest-rank method).
+
+  @param list values
+    The values, in ascending order.
+
+  @param float fraction
+    The percentile to get, as a fraction (e.g., 0.9 for the 90th).
+
+  @return float|None
+    The percentile, or None if there are no values.
+  """
+  if not values:
+    return None
+
+  index = int(math.ceil(fraction * len(values))) - 1
+
+  return values[min(len(values) - 1, max(0, index))]
+
+class Profile(object):
+  """
+  Collects stage timings from verification results.
+  """
+  def __init__(self):
+    self.started = util.clock()
+    self.files   = 0
+    self.cached  = 0
+    self.bytes   = 0
+    self.timings = dict((stage, []) for stage in STAGES)
+
+  def walk(self, paths):
+    """
+    Times a file-discovery generator.
+
+    @param iterable paths
+      The paths to pass through.
+
+    @return generator
+      The same paths.
+    """
+    paths = iter(paths)
+
+    while True:
+      started = util.clock()
+
+      try:
+        path = next(paths)
+      except StopIteration:
+        return
+      finally:
+        self.timings['walk'].append(util.clock() - started)
+
+      yield path
+
+  def add(self, result):
+    """
+    Records the timings of a verification result.
+
+    @param VerificationResult result
+    """
+    self.files += 1
+
+    if result.cached:
+      self.cached += 1
+      return
+
+    for stage, value in result.timings.items():
+      self.timings.setdefault(stage, []).append(value)
+
+    # A stream whose trailing tags couldn't be found has no audio_end
+    if 'crc' in result.timings and result.audio_end is not None:
+      self.bytes += result.audio_end - result.audio_start
+
+  def report(self, logger, workers=None, file=sys.stderr):
+    """
+    Prints a summary of the timings: the total time spent in each stage,
+    per-file percentiles, and the audio throughput the stage alone would
+    allow.
+
+    @param Logger logger
+      A Logger instance for printing messages.
+
+    @param int workers
+      (optional) The number of workers the time was spread across.
+
+    @param file file
+      (optional) The stream to print to.
+    """
+    elapsed = util.clock() - self.started
+    megs    = self.bytes / 1024.0 / 1024.0
+
+    logger.puts(
+      'Profile: %d file(s) (%d cached), %.1f MiB of audio in %.3f s%s' % (
+        self.files, self.cached, megs, elapsed,
+        ' across %d worker(s)' % workers if workers else ''
+      ),
+      file = file
+    )
+    logger.puts(
+      '%-8s %10s %8s %10s %10s %10s %10s' % (
+        'stage', 'total s', 'files', 'p50 ms', 'p90 ms', 'p99 ms', 'MiB/s'
+      ),
+      file = file
+    )
+
+    for stage in STAGES:
+      values = sorted(self.timings.get(stage, []))
+
+      if not values:
+        continue
+
+      total = sum(values)
+
+      # Walking is timed per file found, rather than per file verified
+      if stage == 'walk':
+        logger.puts('%-8s %10.3f' % (stage, total), file = file)
+        continue
+
+      logger.puts(
+        '%-8s %10.3f %8d %10.3f %10.3f %10.3f %10s' % (
+          stage,
+          total,
+          len(values),
+          percentile(values, 0.5) * 1000,
+          percentile(values, 0.9) * 1000,
+          percentile(values, 0.99) * 1000,
+          '%.1f' % (megs / total) if total > 0 and megs else '-'
+        ),
+        file = file
+      )
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""
+Progress reporting (--progress).
+"""
+
+import json
+import sys
+import threading
+
+from mp3sum import util
+
+"""
+The number of seconds between updates of the progress line.
+"""
+LINE_INTERVAL = 0.5
+
+"""
+The number of seconds between progress records (in batch mode, or when
+stderr isn't a terminal).
+"""
+RECORD_INTERVAL = 10.0
+
+def _format_bytes(size):
+  """
+  Formats a byte count for the progress line.
+  """
+  for unit in ('B', 'KiB', 'MiB', 'GiB'):
+    if size < 1024:
+      break
+    size /= 1024.0
+  else:
+    unit = 'TiB'
+
+  return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+
+def _format_duration(seconds):
+  """
+  Formats a number of seconds as h:mm:ss.
+  """
+  seconds = int(seconds)
+  return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class Progress(object):
+  """
+  Tracks and periodically reports the progress of a run.
+
+  The engine tells this about files as they're found and finished; the
+  workers add the bytes they check-sum to a shared counter as they go, so
+  that progress through large files shows up too. Nothing is polled; the
+  report is drawn from these counts on a timer.
+  """
+  def __init__(self, logger, records=False, file=sys.stderr):
+    """
+    @param Logger logger
+      A Logger instance for printing messages.
+
+    @param bool records
+      (optional) Whether to print a JSON record every RECORD_INTERVAL
+      seconds, rather than a progress line that's redrawn in place.
+
+    @param file file
+      (optional) The stream to report to.
+    """
+    import multiprocessing
+
+    self.logger      = logger
+    self.records     = records
+    self.file        = file
+    self.lock        = threading.Lock()
+    self.counter     = multiprocessing.Value('d', 0.0)
+    self.started     = util.clock()
+    self.files_total = 0
+    self.bytes_total = 0
+    self.files_done  = 0
+    self.bytes_done  = 0
+    self.discovering = True
+
+    self._drawn  = False
+    self._stop   = threading.Event()
+    self._ticker = None
+
+  def found(self, size):
+    """
+    Records a file found for checking.
+
+    @param int size
+      The size of the file.
+    """
+    self.files_total += 1
+    self.bytes_total += size
+
+  def discovered(self):
+    """
+    Records that all files have been found.
+    """
+    self.discovering = False
+
+  def finished(self, result, size, counted=False):
+    """
+    Records a file that has been checked.
+
+    @param VerificationResult result
+      The file's result.
+
+    @param int size
+      The size of the file.
+
+    @param bool counted
+      (optional) Whether the workers have already added the bytes of the
+      file's audio stream to the shared counter.
+    """
+    self.files_done += 1
+    self.bytes_done += size
+
+    # The file as a whole is counted now, so take back what the workers
+    # counted of it (which can't be known for a stream whose trailing tags
+    # couldn't be found, as it has no audio_end)
+    if (
+      counted and not result.cached and 'crc' in result.timings
+      and result.audio_end is not None
+    ):
+      with self.counter.get_lock():
+        self.counter.value -= result.audio_end - result.audio_start
+
+  def get_status(self):
+    """
+    Gets the current progress.
+
+    @return dict
+      The files and bytes done and in total (the totals are only complete
+      once discovering is False), the average throughput, and the estimated
+      number of seconds left (or None, if there's no estimate yet).
+    """
+    elapsed    = util.clock() - self.started
+    bytes_done = min(self.bytes_total, self.bytes_done + int(self.counter.value))
+    rate       = bytes_done / elapsed if elapsed > 0 else 0.0
+    eta        = None
+
+    if rate > 0:
+      eta = (self.bytes_total - bytes_done) / rate
+
+    return {
+      'files_done':       self.files_done,
+      'files_total':      self.files_total,
+      'bytes_done':       bytes_done,
+      'bytes_total':      self.bytes_total,
+      'discovering':      self.discovering,
+      'elapsed':          round(elapsed, 3),
+      'bytes_per_second': round(rate, 1),
+      'files_per_second': round(self.files_done / elapsed, 1) if elapsed > 0 else 0.0,
+      'eta':              round(eta, 1) if eta is not None else None,
+    }
+
+  def draw(self):
+    """
+    Prints the current progress, at the same level as results (so that it's
+    quietened by -q).
+    """
+    status = self.get_status()
+
+    if self.records:
+      self.logger.warn(json.dumps({'progress': status}), file = self.file)
+      return
+
+    more = '+' if status['discovering'] else ''
+
+    self.logger.warn(
+      '\r%d/%d%s files, %s/%s%s, %.1f MiB/s, %.1f files/s, ETA %s\x1b[K' % (
+        status['files_done'], status['files_total'], more,
+        _format_bytes(status['bytes_done']),
+        _format_bytes(status['bytes_total']), more,
+        status['bytes_per_second'] / 1024 / 1024,
+        status['files_per_second'],
+        _format_duration(status['eta']) if status['eta'] is not None else '?'
+      ),
+      end  = '',
+      file = self.file
+    )
+    self.file.flush()
+    self._drawn = True
+
+  def clear(self):
+    """
+    Erases the progress line, if it's been drawn.
+    """
+    if self._drawn:
+      self.logger.warn('\r\x1b[K', end = '', file = self.file)
+      self.file.flush()
+      self._drawn = False
+
+  def __enter__(self):
+    """
+    Hides the progress line while other output is printed.
+    """
+    self.lock.acquire()
+    self.clear()
+    return self
+
+  def __exit__(self, *args):
+    self.lock.release()
+
+  def _tick(self):
+    interval = RECORD_INTERVAL if self.records else LINE_INTERVAL
+
+    while not self._stop.wait(interval):
+      with self.lock:
+        self.draw()
+
+  def start(self):
+    """
+    Starts reporting.
+    """
+    self._ticker = threading.Thread(target = self._tick)
+    self._ticker.daemon = True
+    self._ticker.start()
+    return self
+
+  def stop(self):
+    """
+    Stops reporting, printing a final record (or erasing the progress line).
+    """
+    self._stop.set()
+
+    if self._ticker is not None:
+      self._ticker.join()
+
+    with self.lock:
+      if self.records:
+        self.draw()
+      else:
+        self.clear()
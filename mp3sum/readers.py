@@ -0,0 +1,575 @@
+# -*- coding: utf-8 -*-
+
+"""
+File readers used by the verifier.
+"""
+
+import errno
+import os
+import mmap
+
+from mp3sum import util
+
+"""
+The alignment of offsets, lengths and buffers for O_DIRECT reads. This is the
+page size, which is a multiple of the logical block size of any device that
+supports O_DIRECT.
+"""
+DIRECT_ALIGNMENT = mmap.PAGESIZE
+
+"""
+The number of bytes at the end of a stream that are held back from its
+check-sum until EOF, for the trailing tags to be found among (see
+StreamReader.crc16_to_tail()). Streams whose trailing tags are longer than
+this (e.g., an APEv2 tag with a large picture) can't be verified.
+"""
+TAIL_SIZE = 1024 * 1024
+
+def _fadvise(fd, offset, length, advice):
+  """
+  Passes advice about a file's access pattern to the kernel, if the
+  platform supports it.
+
+  @param int fd
+    The file descriptor.
+
+  @param int offset
+    The offset of the range the advice applies to.
+
+  @param int length
+    The length of the range, or 0 for everything up to EOF.
+
+  @param str advice
+    The name of the advice (e.g., 'POSIX_FADV_DONTNEED').
+  """
+  if hasattr(os, 'posix_fadvise') and hasattr(os, advice):
+    try:
+      os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError:
+      pass
+
+class FileReader(object):
+  """
+  Reads a file using ordinary seek() and read() calls.
+
+  If drop_cache is set, the kernel is told that the audio stream will be read
+  sequentially (so that it reads ahead further), and the pages read are
+  dropped from the page cache as soon as they've been check-summed, and the
+  rest when the file is closed. This keeps a full scan from evicting other
+  programs' data.
+  """
+  path       = None
+  size       = 0
+  drop_cache = False
+  seekable   = True
+
+  def __init__(self, path, drop_cache=False):
+    self.path       = path
+    self.drop_cache = drop_cache
+
+    # Unbuffered, so that small reads don't pull in more than they need
+    self._handle = open(path, 'rb', 0)
+
+    try:
+      self.size = os.fstat(self._handle.fileno()).st_size
+    except:
+      self._handle.close()
+      raise
+
+  def read(self, offset, length):
+    """
+    Reads part of the file.
+
+    @param int offset
+      The offset to start reading at.
+
+    @param int length
+      The maximum number of bytes to read.
+
+    @return bytes
+      The data read, which is shorter than length at EOF.
+    """
+    self._handle.seek(offset)
+    return self._handle.read(length)
+
+  def crc16(
+    self,
+    offset,
+    length,
+    read_size = util.READ_SIZE,
+    timings   = None,
+    progress  = None,
+    digest    = None
+  ):
+    """
+    Computes the CRC-16 of part of the file.
+
+    @param int offset
+      The offset to start at.
+
+    @param int length
+      The number of bytes to include.
+
+    @param int read_size
+      (optional) The maximum number of bytes to hold in memory at once.
+
+    @param dict timings
+      (optional) A dict to add the time spent reading and check-summing to
+      (see util.crc16_file()).
+
+    @param callable progress
+      (optional) A function to call with the number of bytes check-summed
+      as the check-sum progresses.
+
+    @param object digest
+      (optional) A hash object to update with the same data (see
+      util.new_digest()).
+
+    @return int
+      The CRC-16.
+    """
+    if self.drop_cache:
+      progress = self._drop(offset, length, progress)
+
+    self._handle.seek(offset)
+    return util.crc16_file(
+      self._handle, length, read_size, timings, progress, digest
+    )
+
+  def _drop(self, offset, length, progress=None):
+    """
+    Advises sequential access to part of the file, and gets a progress
+    function that drops each chunk from the page cache once it's been
+    check-summed.
+
+    @param int offset
+      The offset of the part.
+
+    @param int length
+      The length of the part.
+
+    @param callable progress
+      (optional) A progress function to wrap.
+
+    @return callable
+    """
+    fd       = self._handle.fileno()
+    position = [offset]
+
+    _fadvise(fd, offset, length, 'POSIX_FADV_SEQUENTIAL')
+
+    def drop(size):
+      _fadvise(fd, position[0], size, 'POSIX_FADV_DONTNEED')
+      position[0] += size
+
+      if progress is not None:
+        progress(size)
+
+    return drop
+
+  def close(self):
+    if self.drop_cache:
+      _fadvise(self._handle.fileno(), 0, 0, 'POSIX_FADV_DONTNEED')
+
+    self._handle.close()
+
+class MmapReader(FileReader):
+  """
+  Reads a file through a read-only memory map.
+
+  Check-sums are computed over memoryview slices of the map, so the audio
+  stream is never copied; the kernel's readahead takes care of the I/O.
+  Plain reads (of headers and tags) are still returned as bytes.
+  """
+  def __init__(self, path, drop_cache=False):
+    FileReader.__init__(self, path, drop_cache)
+
+    try:
+      self._map = mmap.mmap(
+        self._handle.fileno(), 0, access = mmap.ACCESS_READ
+      )
+    except:
+      self._handle.close()
+      raise
+
+  def read(self, offset, length):
+    return self._map[offset:offset + length]
+
+  def crc16(
+    self,
+    offset,
+    length,
+    read_size = util.READ_SIZE,
+    timings   = None,
+    progress  = None,
+    digest    = None
+  ):
+    # Reads happen as page faults during check-summing, so all of the time
+    # is counted as 'crc'
+    started = util.clock()
+    end     = min(offset + length, self.size)
+
+    # Tell the kernel we're about to stream through this range
+    if hasattr(self._map, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+      start = offset - offset % mmap.PAGESIZE
+      if end > start:
+        self._map.madvise(mmap.MADV_SEQUENTIAL, start, end - start)
+
+    crc  = 0
+    view = memoryview(self._map)
+
+    try:
+      for start in range(offset, end, read_size):
+        chunk = view[start:min(start + read_size, end)]
+        crc   = util.crc16(chunk, crc)
+
+        if digest is not None:
+          digest.update(chunk)
+
+        if progress is not None:
+          progress(len(chunk))
+    finally:
+      view.release()
+
+    if timings is not None:
+      timings['crc'] = timings.get('crc', 0.0) + util.clock() - started
+
+    return crc
+
+  def close(self):
+    # Mapped pages can't be dropped from the page cache, so this comes first
+    self._map.close()
+    FileReader.close(self)
+
+class DirectReader(FileReader):
+  """
+  Reads a file with O_DIRECT, bypassing the page cache altogether.
+
+  O_DIRECT reads have to start and end on block boundaries and land in an
+  aligned buffer, so each read covers the aligned range around the data
+  wanted, into a page-aligned anonymous map, and the data is sliced out.
+  """
+  def __init__(self, path):
+    self.path = path
+    self._fd  = os.open(path, os.O_RDONLY | os.O_DIRECT)
+    self._buf = None
+
+    try:
+      self.size = os.fstat(self._fd).st_size
+    except:
+      os.close(self._fd)
+      raise
+
+  def _chunks(self, offset, length, read_size=util.READ_SIZE):
+    """
+    Reads part of the file in aligned chunks.
+
+    @param int offset
+      The offset to start at.
+
+    @param int length
+      The maximum number of bytes to read.
+
+    @param int read_size
+      (optional) The maximum number of bytes to read at once. This is rounded
+      up to a multiple of DIRECT_ALIGNMENT.
+
+    @return generator
+      Memoryview slices of the data read, which are only valid until the next
+      one is produced.
+    """
+    size = -(-max(read_size, 1) // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT
+    end  = min(offset + length, self.size)
+
+    if self._buf is None or len(self._buf) < size:
+      if self._buf is not None:
+        self._buf.close()
+      self._buf = mmap.mmap(-1, size)
+
+    view     = memoryview(self._buf)
+    position = offset - offset % DIRECT_ALIGNMENT
+
+    try:
+      while position < end:
+        count = os.preadv(self._fd, [view[:size]], position)
+
+        if count <= 0:
+          break
+
+        start     = max(offset - position, 0)
+        stop      = min(count, end - position)
+        position += count
+
+        if stop > start:
+          yield view[start:stop]
+
+        # A short read means EOF
+        if count < size:
+          break
+    finally:
+      view.release()
+
+  def read(self, offset, length):
+    return b''.join(bytes(chunk) for chunk in self._chunks(offset, length, length))
+
+  def crc16(
+    self,
+    offset,
+    length,
+    read_size = util.READ_SIZE,
+    timings   = None,
+    progress  = None,
+    digest    = None
+  ):
+    crc       = 0
+    read_time = 0.0
+    crc_time  = 0.0
+    started   = util.clock()
+
+    for chunk in self._chunks(offset, length, read_size):
+      read       = util.clock()
+      read_time += read - started
+      crc        = util.crc16(chunk, crc)
+
+      if digest is not None:
+        digest.update(chunk)
+
+      started   = util.clock()
+      crc_time += started - read
+
+      if progress is not None:
+        progress(len(chunk))
+
+    if timings is not None:
+      timings['read'] = timings.get('read', 0.0) + read_time
+      timings['crc']  = timings.get('crc', 0.0) + crc_time
+
+    return crc
+
+  def close(self):
+    if self._buf is not None:
+      self._buf.close()
+    os.close(self._fd)
+
+class BufferReader(object):
+  """
+  Reads the end of a file from memory.
+  """
+  seekable = True
+
+  def __init__(self, data, offset=0):
+    """
+    @param bytes data
+      The last bytes of the file.
+
+    @param int offset
+      (optional) The offset of the data in the file.
+    """
+    self.data   = data
+    self.offset = offset
+    self.size   = offset + len(data)
+
+  def read(self, offset, length):
+    """
+    Reads part of the file (see FileReader.read()).
+
+    @raise IOError
+      If the part starts before the data held.
+    """
+    if offset < self.offset:
+      raise IOError('offset %d is before the data held' % offset)
+    return self.data[offset - self.offset:offset - self.offset + length]
+
+class StreamReader(object):
+  """
+  Reads a file that can only be read from start to end, such as an archive
+  member or a pipe.
+
+  Reads must come at the same or increasing offsets; data before the last
+  offset read is discarded, and data skipped over is read and discarded, so
+  memory use is bounded by the reads asked for. The trailing tags of a
+  stream can't be looked for before its audio has been read, so the audio
+  is check-summed on the way to EOF instead (see crc16_to_tail()).
+  """
+  seekable = False
+
+  def __init__(self, handle, size=None, tail_size=TAIL_SIZE):
+    """
+    @param file handle
+      The stream, opened in binary mode. It's left open by close().
+
+    @param int size
+      (optional) The size of the stream, if it's known in advance. Otherwise,
+      this is filled in once EOF is reached.
+
+    @param int tail_size
+      (optional) The number of bytes that crc16_to_tail() holds back.
+    """
+    self.size      = size
+    self.tail_size = tail_size
+
+    self._handle   = handle
+    self._buffer   = bytearray() # Data from self._offset on
+    self._offset   = 0
+    self._consumed = 0
+    self._eof      = False
+
+  def _read(self, length):
+    """
+    Reads from the stream, noting its size at EOF.
+    """
+    data = self._handle.read(length)
+
+    if data:
+      self._consumed += len(data)
+    else:
+      self._eof = True
+      self.size = self._consumed
+
+    return data
+
+  def _skip(self, offset, read_size=util.READ_SIZE):
+    """
+    Discards the data before an offset.
+    """
+    if offset < self._offset:
+      raise IOError('cannot read backwards in a stream (offset %d)' % offset)
+
+    skip = offset - self._offset
+
+    if skip <= len(self._buffer):
+      del self._buffer[:skip]
+    else:
+      skip -= len(self._buffer)
+      self._buffer = bytearray()
+
+      while skip > 0 and self._read(min(skip, read_size)):
+        skip = offset - self._consumed
+
+    self._offset = offset
+
+  def read(self, offset, length):
+    """
+    Reads part of the stream (see FileReader.read()).
+
+    @raise IOError
+      If the offset is before that of the last read.
+    """
+    self._skip(offset)
+
+    while len(self._buffer) < length and not self._eof:
+      self._buffer += self._read(length - len(self._buffer))
+
+    return bytes(self._buffer[:length])
+
+  def crc16_to_tail(
+    self,
+    offset,
+    read_size = util.READ_SIZE,
+    timings   = None,
+    progress  = None,
+    digest    = None
+  ):
+    """
+    Computes the CRC-16 of the stream from an offset to EOF, less the last
+    tail_size bytes (or more), which are held back.
+
+    @param int offset
+      The offset to start at. This must be at or after the last read.
+
+    @param int read_size
+      (optional) The maximum number of bytes to read at once.
+
+    @param dict timings
+      (optional) A dict to add the time spent reading and check-summing to
+      (see util.crc16_file()).
+
+    @param callable progress
+      (optional) A function to call with the number of bytes check-summed
+      as the check-sum progresses.
+
+    @param object digest
+      (optional) A hash object to update with the same data (see
+      util.new_digest()).
+
+    @return tuple
+      The CRC-16, and a BufferReader for the bytes held back (whose size is
+      the stream's), which the caller can finish the check-sum with.
+    """
+    self._skip(offset, read_size)
+
+    crc       = 0
+    read_time = 0.0
+    crc_time  = 0.0
+
+    while not self._eof:
+      started    = util.clock()
+      data       = self._read(read_size)
+      read       = util.clock()
+      read_time += read - started
+
+      self._buffer += data
+
+      if len(self._buffer) < self.tail_size + read_size:
+        continue
+
+      count = len(self._buffer) - self.tail_size
+      chunk = bytes(self._buffer[:count])
+      crc   = util.crc16(chunk, crc)
+
+      if digest is not None:
+        digest.update(chunk)
+
+      del self._buffer[:count]
+      self._offset += count
+      crc_time     += util.clock() - read
+
+      if progress is not None:
+        progress(count)
+
+    if timings is not None:
+      timings['read'] = timings.get('read', 0.0) + read_time
+      timings['crc']  = timings.get('crc', 0.0) + crc_time
+
+    return (crc, BufferReader(bytes(self._buffer), self._offset))
+
+  def close(self):
+    self._buffer = bytearray()
+
+def open_reader(path, use_mmap=False, drop_cache=False, direct=False):
+  """
+  Opens a file for verification.
+
+  @param str path
+    The path to the file.
+
+  @param bool use_mmap
+    (optional) Whether to memory-map the file. Files that can't be mapped
+    (such as empty ones) fall back to ordinary reads.
+
+  @param bool drop_cache
+    (optional) Whether to keep the file out of the page cache where possible
+    (see FileReader).
+
+  @param bool direct
+    (optional) Whether to read the file with O_DIRECT. This takes precedence
+    over use_mmap. Where O_DIRECT isn't supported (by the platform or the
+    file system), the file is read as with drop_cache instead.
+
+  @return FileReader
+    A FileReader, MmapReader or DirectReader instance.
+  """
+  if direct:
+    if hasattr(os, 'O_DIRECT') and hasattr(os, 'preadv'):
+      try:
+        return DirectReader(path)
+      except OSError as e:
+        if e.errno != errno.EINVAL:
+          raise
+    drop_cache = True
+  elif use_mmap:
+    try:
+      return MmapReader(path, drop_cache)
+    except (ValueError, mmap.error):
+      pass
+  return FileReader(path, drop_cache)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+Verification server and client.
+
+The server listens on a Unix domain socket and keeps a pool of worker
+processes and the result cache open between requests, so that verifying a
+few files doesn't mean paying for a new interpreter and pool each time.
+
+Requests and responses are JSON objects, one per line. A request looks like
+this (only paths is required):
+
+  {"paths": ["/music/a.mp3", "/music/b"], "recursive": true,
+   "ordered": false, "rehash": false, "shard": [2, 4]}
+
+The server answers with one line per file, as VerificationResult.as_dict()
+produces it, followed by a summary line:
+
+  {"done": true, "count": 2}
+
+or, if the request couldn't be understood, a single error line:
+
+  {"error": "..."}
+
+Any number of requests may be sent over one connection. Requests are served
+one at a time; the workers are shared between them.
+"""
+
+import copy
+import json
+import os
+import signal
+import socket
+import stat
+
+try:
+  import socketserver
+except ImportError:
+  import SocketServer as socketserver
+
+from mp3sum import discovery
+from mp3sum import engine
+from mp3sum import util
+from mp3sum import verifier
+
+class _Handler(socketserver.StreamRequestHandler):
+  """
+  Serves the requests on one connection.
+  """
+  def send(self, values):
+    self.wfile.write((json.dumps(values) + '\n').encode('utf-8'))
+
+  def handle(self):
+    server = self.server
+
+    for line in self.rfile:
+      if not line.strip():
+        continue
+
+      try:
+        request = json.loads(line.decode('utf-8'))
+
+        if not isinstance(request, dict):
+          raise TypeError('request must be an object')
+
+        paths = request['paths']
+
+        if not isinstance(paths, list):
+          raise TypeError('paths must be a list')
+        # JSON strings are unicode, on Python 2 as well. Paths with null
+        # characters can't be opened at all
+        if not all(isinstance(path, type(u'')) for path in paths):
+          raise TypeError('paths must be strings')
+        if any(u'\0' in path for path in paths):
+          raise ValueError('paths must not contain null characters')
+
+      except (ValueError, KeyError, TypeError) as e:
+        self.send({'error': 'bad request: %s' % e})
+        continue
+
+      options           = copy.copy(server.options)
+      options.ordered   = bool(request.get('ordered', options.ordered))
+      options.rehash    = bool(request.get('rehash', options.rehash))
+      options.recursive = bool(request.get('recursive', options.recursive))
+
+      try:
+        if request.get('shard') is not None:
+          options.shard = util.parse_shard('%d/%d' % tuple(request['shard']))
+      except (ValueError, TypeError) as e:
+        self.send({'error': 'bad request: %s' % e})
+        continue
+
+      server.logger.info('Checking %d path(s)' % len(paths))
+
+      count = 0
+
+      try:
+        for result in engine.run(
+          discovery.find_mp3s(paths, options.recursive, shard = options.shard),
+          options,
+          server.store,
+          server.pool
+        ):
+          if result.result == verifier.ERROR_NOT_MP3:
+            continue
+          self.send(result.as_dict())
+          count += 1
+      finally:
+        if server.store is not None:
+          server.store.commit()
+
+      self.send({'done': True, 'count': count})
+
+class _Server(socketserver.UnixStreamServer):
+  """
+  A Unix-socket server holding the state shared between requests.
+  """
+  def __init__(self, path, options, logger, store=None):
+    self.options = options
+    self.logger  = logger
+    self.store   = store
+    self.pool    = None
+    socketserver.UnixStreamServer.__init__(self, path, _Handler)
+
+  def handle_error(self, request, client_address):
+    # Clients going away mid-response are routine
+    self.logger.info('Request failed; dropping connection')
+
+def _remove_stale(path):
+  """
+  Removes a socket file left behind by a server that's no longer running.
+
+  @param str path
+    The path to the socket.
+
+  @raise socket.error
+    If a server is already listening on the path, or the path is something
+    other than a socket.
+  """
+  try:
+    mode = os.lstat(path).st_mode
+  except OSError:
+    return
+
+  if not stat.S_ISSOCK(mode):
+    raise socket.error('path exists and is not a socket: %s' % path)
+
+  probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+  try:
+    probe.connect(path)
+  except socket.error:
+    os.unlink(path)
+  else:
+    raise socket.error('server already running on %s' % path)
+  finally:
+    probe.close()
+
+def _terminate(signum, frame):
+  raise SystemExit(0)
+
+def serve(path, options, logger, store=None):
+  """
+  Serves verification requests until interrupted.
+
+  @param str path
+    The path of the socket to listen on.
+
+  @param argparse.Namespace options
+    The parsed command-line options. The workers' settings (e.g., --quick
+    and --read-size) apply to every request.
+
+  @param Logger logger
+    A Logger instance for printing messages.
+
+  @param Cache store
+    (optional) A result cache to consult and update.
+  """
+  _remove_stale(path)
+
+  server = _Server(path, options, logger, store)
+
+  try:
+    server.pool = engine.create_pool(options)
+
+    # Installed after the workers are started, so that only this process
+    # handles it
+    signal.signal(signal.SIGTERM, _terminate)
+
+    logger.info('Listening on %s' % path)
+    server.serve_forever()
+  finally:
+    server.server_close()
+
+    if server.pool is not None:
+      server.pool.terminate()
+
+    try:
+      os.unlink(path)
+    except OSError:
+      pass
+
+def request(
+  path,
+  paths,
+  recursive = False,
+  ordered   = False,
+  rehash    = False,
+  shard     = None
+):
+  """
+  Sends a verification request to a server.
+
+  @param str path
+    The path of the server's socket.
+
+  @param list paths
+    The paths to verify. Relative paths are resolved here, but results
+    are reported with the paths as given.
+
+  @param bool recursive
+    (optional) Whether to descend into sub-directories.
+
+  @param bool ordered
+    (optional) Whether to receive results in path order.
+
+  @param bool rehash
+    (optional) Whether to verify files even if their cached results are
+    current.
+
+  @param tuple shard
+    (optional) The index (counting from 0) and count of the shard to verify
+    (see discovery.find_mp3s()).
+
+  @return generator
+    VerificationResult instances.
+  """
+  originals = dict((os.path.abspath(p), p) for p in paths)
+  client    = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+  try:
+    client.connect(path)
+    client.sendall((json.dumps({
+      'paths':     [os.path.abspath(p) for p in paths],
+      'recursive': recursive,
+      'ordered':   ordered,
+      'rehash':    rehash,
+      'shard':     [shard[0] + 1, shard[1]] if shard is not None else None,
+    }) + '\n').encode('utf-8'))
+
+    for line in client.makefile('rb'):
+      values = json.loads(line.decode('utf-8'))
+
+      if 'error' in values:
+        raise IOError('server error: %s' % values['error'])
+      if values.get('done'):
+        return
+
+      result = verifier.VerificationResult.from_dict(values)
+
+      # Files found in directories are reported as the server found them
+      # (i.e., absolute); show them relative to the directory given
+      if result.path not in originals:
+        for absolute, original in originals.items():
+          if result.path.startswith(absolute + os.sep):
+            result.path = os.path.join(
+              original, result.path[len(absolute) + len(os.sep):]
+            )
+            break
+      else:
+        result.path = originals[result.path]
+
+      yield result
+
+    raise IOError('server closed connection')
+  finally:
+    client.close()
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+"""
+Machine-readable result output (--format jsonl, --output-db and
+--checkpoint), and reading it back (mp3sum merge and --resume).
+"""
+
+import json
+import os
+import sqlite3
+
+from mp3sum import util
+from mp3sum import verifier
+
+"""
+The fields of a result record, in order.
+"""
+RECORD_FIELDS = (
+  'path',
+  'result',
+  'status',
+  'tag_crc_now',
+  'tag_crc',
+  'music_crc_now',
+  'music_crc',
+  'audio_start',
+  'audio_end',
+  'size',
+  'duration',
+  'cached',
+  'digest',
+)
+
+"""
+The number of queued records that triggers a database commit.
+"""
+COMMIT_INTERVAL = 5000
+
+"""
+The number of seconds after which queued checkpoint records are written out
+(and synced to disk).
+"""
+CHECKPOINT_INTERVAL = 5.0
+
+_statuses = {
+  verifier.ERROR_OK:             'pass',
+  verifier.ERROR_TAG_OK:         'tag',
+  verifier.ERROR_UNSUPPORTED:    'unsupported',
+  verifier.ERROR_TAG_MISMATCH:   'fail',
+  verifier.ERROR_MUSIC_MISMATCH: 'fail',
+}
+
+_schema = '''
+  CREATE TABLE IF NOT EXISTS results (
+    path          TEXT PRIMARY KEY,
+    result        INTEGER NOT NULL,
+    status        TEXT NOT NULL,
+    tag_crc_now   INTEGER NOT NULL,
+    tag_crc       INTEGER NOT NULL,
+    music_crc_now INTEGER NOT NULL,
+    music_crc     INTEGER NOT NULL,
+    audio_start   INTEGER,
+    audio_end     INTEGER,
+    size          INTEGER,
+    duration      REAL,
+    cached        INTEGER NOT NULL,
+    digest        TEXT
+  )
+'''
+
+def get_record(result, path=None):
+  """
+  Gets the values recorded for a result.
+
+  @param VerificationResult result
+
+  @param str path
+    (optional) The path to record, if not the result's own.
+
+  @return tuple
+    The values of RECORD_FIELDS. The duration is the time the check took,
+    in seconds, or None if the result came from the cache.
+  """
+  return (
+    result.path if path is None else path,
+    result.result,
+    _statuses.get(result.result, 'unknown'),
+  ) + result.crcs + (
+    result.audio_start,
+    result.audio_end,
+    result.size,
+    result.timings.get('total'),
+    bool(result.cached),
+    result.digest,
+  )
+
+def _get_columns(db):
+  """
+  Gets the fields of RECORD_FIELDS that a results database has columns for
+  (databases written by older versions lack the newer ones).
+
+  @param sqlite3.Connection db
+
+  @return list
+  """
+  columns = set(row[1] for row in db.execute('PRAGMA table_info(results)'))
+  return [field for field in RECORD_FIELDS if field in columns]
+
+def get_result(record):
+  """
+  Creates a result from a record, as written by one of the sinks below.
+
+  @param dict record
+    The values of RECORD_FIELDS, by name.
+
+  @return VerificationResult
+  """
+  result = verifier.VerificationResult(
+    record['path'],
+    int(record['result']),
+    tuple(record[field] for field in RECORD_FIELDS[3:7])
+  )
+  result.audio_start = record.get('audio_start')
+  result.audio_end   = record.get('audio_end')
+  result.size        = record.get('size')
+  result.digest      = record.get('digest')
+  result.cached      = bool(record.get('cached'))
+
+  if record.get('duration') is not None:
+    result.timings['total'] = record['duration']
+
+  return result
+
+def read_results(path):
+  """
+  Reads the results from a file written by JsonLinesSink or SqliteSink.
+
+  @param str path
+    The path to the file. SQLite databases are recognised by their header;
+    anything else is read as JSON Lines.
+
+  @return generator
+    VerificationResult instances.
+  """
+  with open(path, 'rb') as handle:
+    if handle.read(16) != b'SQLite format 3\x00':
+      handle.seek(0)
+
+      for line in handle:
+        if line.strip():
+          yield get_result(json.loads(line.decode('utf-8')))
+      return
+
+  db = sqlite3.connect(path)
+
+  try:
+    fields = _get_columns(db)
+    cursor = db.execute('SELECT %s FROM results' % ', '.join(fields))
+
+    for row in cursor:
+      yield get_result(dict(zip(fields, row)))
+  finally:
+    db.close()
+
+def merge_results(paths):
+  """
+  Reads and combines the results from several files (e.g., one per shard).
+
+  @param iterable paths
+    The paths to the files (see read_results()).
+
+  @return list
+    VerificationResult instances, in the order their paths were first seen.
+    Where a path appears more than once, the last result read for it wins.
+  """
+  results = {}
+  order   = []
+
+  for path in paths:
+    for result in read_results(path):
+      if result.path not in results:
+        order.append(result.path)
+      results[result.path] = result
+
+  return [results[path] for path in order]
+
+class JsonLinesSink(object):
+  """
+  Writes results as JSON objects, one per line.
+  """
+  def __init__(self, file, options=None):
+    """
+    @param file file
+      The stream to write to.
+
+    @param argparse.Namespace options
+      (optional) The parsed command-line options, which decide which results
+      are written and how their paths are shown (see verifier.is_shown() and
+      verifier.get_display_path()). If this is None, all results are
+      written as they are.
+    """
+    self.file    = file
+    self.options = options
+
+  def write(self, result):
+    if self.options is not None and not verifier.is_shown(self.options, result):
+      return self
+
+    path = verifier.get_display_path(result.path, self.options)
+
+    self.file.write(
+      json.dumps(dict(zip(RECORD_FIELDS, get_record(result, path)))) + '\n'
+    )
+    return self
+
+  def close(self):
+    self.file.flush()
+
+class SqliteSink(object):
+  """
+  Writes results to an SQLite database, in batched transactions. Paths are
+  stored in absolute form; results for paths already in the database
+  replace the old ones.
+  """
+  path = None
+
+  def __init__(self, path):
+    """
+    @param str path
+      The path to the database file, which is created if need be.
+    """
+    self.path = path
+
+    directory = os.path.dirname(self.path)
+
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    self._db      = sqlite3.connect(self.path)
+    self._pending = []
+
+    self._db.execute(_schema)
+
+    # Add any columns that an older version didn't know about
+    columns = _get_columns(self._db)
+
+    for field in RECORD_FIELDS:
+      if field not in columns:
+        self._db.execute('ALTER TABLE results ADD COLUMN %s' % field)
+
+    self._db.commit()
+
+  def write(self, result):
+    self._pending.append(get_record(result, os.path.abspath(result.path)))
+
+    if len(self._pending) >= COMMIT_INTERVAL:
+      self.commit()
+
+    return self
+
+  def commit(self):
+    """
+    Writes all queued results to the database in a single transaction.
+    """
+    if self._pending:
+      with self._db:
+        self._db.executemany(
+          'INSERT OR REPLACE INTO results (%s) VALUES (%s)' % (
+            ', '.join(RECORD_FIELDS), ', '.join('?' * len(RECORD_FIELDS))
+          ),
+          self._pending
+        )
+      self._pending = []
+    return self
+
+  def close(self):
+    """
+    Commits any queued results and closes the database.
+    """
+    self.commit()
+    self._db.close()
+
+class CheckpointSink(object):
+  """
+  Records the results of a run as it goes, so that it can be resumed.
+
+  The checkpoint is a JSON Lines file (see read_results()) that's only ever
+  appended to; records are queued and written out in whole lines, then
+  synced to disk, every CHECKPOINT_INTERVAL seconds. A crash can therefore
+  lose the last few results, or leave a partial line at the end of the file,
+  but never corrupt the results before it.
+  """
+  path = None
+
+  def __init__(self, path, resume=False):
+    """
+    @param str path
+      The path to the checkpoint file.
+
+    @param bool resume
+      (optional) Whether to load the results recorded by an earlier run and
+      add to them. Otherwise, any existing checkpoint is started over.
+    """
+    self.path    = path
+    self.results = {}
+
+    self._pending = []
+    self._synced  = util.clock()
+
+    if resume and os.path.exists(self.path):
+      self._file = open(self.path, 'r+b')
+      self._load()
+    else:
+      self._file = open(self.path, 'wb')
+
+  def _load(self):
+    """
+    Loads the results recorded in the checkpoint, dropping any partial line
+    left at the end by an interrupted write.
+    """
+    end = 0
+
+    for line in self._file:
+      if not line.endswith(b'\n'):
+        break
+
+      if line.strip():
+        result = get_result(json.loads(line.decode('utf-8')))
+        self.results[result.path] = result
+
+      end += len(line)
+
+    self._file.seek(end)
+    self._file.truncate()
+
+  def is_done(self, path):
+    """
+    Determines whether a file has a result in the checkpoint.
+
+    @param str path
+      The path to the file.
+
+    @return bool
+    """
+    return os.path.abspath(path) in self.results
+
+  def write(self, result):
+    path = os.path.abspath(result.path)
+
+    self._pending.append(
+      json.dumps(dict(zip(RECORD_FIELDS, get_record(result, path)))) + '\n'
+    )
+
+    if util.clock() - self._synced >= CHECKPOINT_INTERVAL:
+      self.sync()
+
+    return self
+
+  def sync(self):
+    """
+    Writes out all queued records and syncs them to disk.
+    """
+    if self._pending:
+      self._file.write(''.join(self._pending).encode('utf-8'))
+      self._file.flush()
+      os.fsync(self._file.fileno())
+      self._pending = []
+
+    self._synced = util.clock()
+    return self
+
+  def close(self):
+    """
+    Writes out any queued records and closes the checkpoint.
+    """
+    self.sync()
+    self._file.close()
@@ -4,12 +4,508 @@
 Utility functions.
 """
 
-import crcmod.predefined
+import hashlib
+import os
+import sys
+import time
 
+# NumPy is slow to import, so it's only imported if the CRC-16 backends are
+# needed (see get_crc16_backends())
+numpy = None
+
+"""
+The (reflected) generator polynomial of the CRC-16 used by LAME (also known as
+CRC-16/ARC): x^16 + x^15 + x^2 + 1, with an initial value of 0 and no final
+XOR.
+"""
+CRC16_POLYNOMIAL = 0xa001
+
+"""
+The environment variable that may be used to force a particular CRC-16
+backend (see get_crc16_backends()).
+"""
+CRC16_BACKEND_ENV = 'MP3SUM_CRC16_BACKEND'
+
+"""
+The smallest buffer that the NumPy backend vectorises; below this the lookup
+tables are quicker.
+"""
+NUMPY_MIN_SIZE = 16 * 1024
+
+"""
+The number of interleaved lanes the NumPy backend splits a buffer into.
 """
-Computes the CRC-16 check-sum of a string.
+NUMPY_LANES = 1024
+
+"""
+The default number of bytes to read at a time when streaming file data.
+"""
+READ_SIZE = 256 * 1024
+
+"""
+The digests that may be computed over audio streams (see new_digest()).
+xxh64 needs the xxhash module.
 """
-crc16 = crcmod.predefined.mkCrcFun('crc-16')
+DIGESTS = ('blake2b', 'sha256', 'xxh64')
+
+"""
+A monotonic clock (where available), for timings.
+"""
+clock = getattr(time, 'monotonic', time.time)
+
+_size_suffixes = {
+  'K': 1024,
+  'M': 1024 ** 2,
+  'G': 1024 ** 3,
+}
+
+def crc16_file(
+  handle,
+  length    = None,
+  read_size = READ_SIZE,
+  timings   = None,
+  progress  = None,
+  digest    = None
+):
+  """
+  Computes the CRC-16 check-sum of a file's contents incrementally, starting
+  from the handle's current position.
+
+  @param file handle
+    A file handle opened in binary mode.
+
+  @param int length
+    (optional) The number of bytes to include. If this is None (the default),
+    everything up to EOF is included.
+
+  @param int read_size
+    (optional) The maximum number of bytes to hold in memory at once.
+
+  @param dict timings
+    (optional) A dict to add the time spent reading and check-summing to, in
+    seconds, under 'read' and 'crc'.
+
+  @param callable progress
+    (optional) A function to call with the number of bytes check-summed
+    after each read.
+
+  @param object digest
+    (optional) A hash object (see new_digest()) to update with the same
+    data. The time this takes is counted as 'crc'.
+
+  @return int
+    The computed CRC-16.
+  """
+  crc       = 0
+  read_time = 0.0
+  crc_time  = 0.0
+
+  while length is None or length > 0:
+    size    = read_size if length is None else min(read_size, length)
+    started = clock()
+    chunk   = handle.read(size)
+    read    = clock()
+
+    read_time += read - started
+
+    if not chunk:
+      break
+
+    crc = crc16(chunk, crc)
+
+    if digest is not None:
+      digest.update(chunk)
+
+    crc_time += clock() - read
+
+    if progress is not None:
+      progress(len(chunk))
+
+    if length is not None:
+      length -= len(chunk)
+
+  if timings is not None:
+    timings['read'] = timings.get('read', 0.0) + read_time
+    timings['crc']  = timings.get('crc', 0.0) + crc_time
+
+  return crc
+
+def _gf2_matrix_times(matrix, vector):
+  result = 0
+  row    = 0
+
+  while vector:
+    if vector & 1:
+      result ^= matrix[row]
+    vector >>= 1
+    row     += 1
+
+  return result
+
+def _gf2_matrix_multiply(matrix1, matrix2):
+  return [_gf2_matrix_times(matrix1, row) for row in matrix2]
+
+def _crc16_zeros_operator(length):
+  """
+  Builds the matrix that advances a CRC-16 past a run of zero bytes.
+
+  @param int length
+    The number of zero bytes; must be greater than 0.
+
+  @return list
+    The operator, as a list of 16 columns.
+  """
+  # Operator for a single zero bit: the polynomial, then a shift
+  operator = [CRC16_POLYNOMIAL] + [1 << n for n in range(15)]
+
+  # Square it up to a single zero byte
+  for _ in range(3):
+    operator = _gf2_matrix_multiply(operator, operator)
+
+  # Then combine the powers of it that correspond to each bit in the length
+  result = None
+
+  while length:
+    if length & 1:
+      result = operator if result is None else _gf2_matrix_multiply(
+        operator, result
+      )
+    length >>= 1
+    if length:
+      operator = _gf2_matrix_multiply(operator, operator)
+
+  return result
+
+def crc16_combine(crc1, crc2, length2):
+  """
+  Combines the CRC-16 check-sums of two adjacent blocks of data.
+
+  This works like zlib's crc32_combine(): crc1 is advanced past length2 zero
+  bytes (using an operator built by repeated squaring), which leaves only
+  crc2 to be mixed in. It takes O(log length2) time, so the check-sums of
+  separately processed segments can be merged cheaply.
+
+  @param int crc1
+    The CRC-16 of the first block.
+
+  @param int crc2
+    The CRC-16 of the second block.
+
+  @param int length2
+    The length of the second block, in bytes.
+
+  @return int
+    The CRC-16 of the two blocks concatenated.
+  """
+  if length2 <= 0:
+    return crc1
+  return _gf2_matrix_times(_crc16_zeros_operator(length2), crc1) ^ crc2
+
+def _crc16_tables(count=8):
+  """
+  Builds the lookup tables for the slicing-by-N CRC-16 implementation.
+
+  @param int count
+    (optional) The number of tables (bytes per step) to build.
+
+  @return list
+    A list of tables, where table k maps a byte to the CRC-16 of that byte
+    followed by k zero bytes.
+  """
+  table = []
+
+  for byte in range(256):
+    crc = byte
+    for _ in range(8):
+      crc = (crc >> 1) ^ CRC16_POLYNOMIAL if crc & 1 else crc >> 1
+    table.append(crc)
+
+  tables = [table]
+
+  for _ in range(count - 1):
+    tables.append([(crc >> 8) ^ table[crc & 0xff] for crc in tables[-1]])
+
+  return tables
+
+_tables = _crc16_tables()
+
+def _crc16_table(data, crc=0):
+  """
+  Computes a CRC-16 in pure Python, eight bytes at a time (slicing-by-8).
+  """
+  t0, t1, t2, t3, t4, t5, t6, t7 = _tables
+
+  data   = memoryview(data) if sys.version_info[0] > 2 else bytearray(data)
+  length = len(data)
+  end    = length - length % 8
+  it     = iter(data[:end])
+
+  for b0, b1, b2, b3, b4, b5, b6, b7 in zip(it, it, it, it, it, it, it, it):
+    crc ^= b0 | b1 << 8
+    crc  = (
+      t7[crc & 0xff] ^ t6[crc >> 8] ^ t5[b2] ^ t4[b3] ^
+      t3[b4] ^ t2[b5] ^ t1[b6] ^ t0[b7]
+    )
+
+  for byte in data[end:]:
+    crc = (crc >> 8) ^ t0[(crc ^ byte) & 0xff]
+
+  return crc
+
+def _crc16_numpy_rows(matrix, crcs):
+  """
+  Advances a vector of CRC-16s through the rows of a byte matrix, so that
+  column n of the matrix is check-summed into crcs[n].
+  """
+  table = _numpy_table
+
+  for row in matrix:
+    crcs = (crcs >> 8) ^ table[(crcs ^ row) & 0xff]
+
+  return crcs
+
+def _crc16_numpy(data, crc=0):
+  """
+  Computes a CRC-16 using NumPy.
+
+  The buffer is (front-padded with zeros, which don't affect a CRC-16 with
+  an initial value of 0, and) split into NUMPY_LANES equal lanes that are
+  check-summed side by side. Neighbouring lanes are then merged pairwise
+  with vectorised crc16_combine() operations until one CRC-16 remains.
+  """
+  length = len(data)
+
+  if length < NUMPY_MIN_SIZE:
+    return _crc16_table(data, crc)
+
+  lanes  = NUMPY_LANES
+  width  = -(-length // lanes)
+  padded = numpy.zeros(lanes * width, dtype = numpy.uint8)
+
+  padded[lanes * width - length:] = numpy.frombuffer(data, dtype = numpy.uint8)
+
+  crcs = _crc16_numpy_rows(
+    numpy.ascontiguousarray(padded.reshape(lanes, width).T),
+    numpy.zeros(lanes, dtype = numpy.uint16)
+  )
+
+  operator = _crc16_zeros_operator(width)
+
+  while len(crcs) > 1:
+    shifted = numpy.zeros(len(crcs) // 2, dtype = numpy.uint16)
+
+    for bit, column in enumerate(operator):
+      shifted ^= ((crcs[0::2] >> bit) & 1) * numpy.uint16(column)
+
+    crcs     = shifted ^ crcs[1::2]
+    operator = _gf2_matrix_multiply(operator, operator)
+
+  return crc16_combine(crc, int(crcs[0]), length)
+
+def _crcmod_crc16():
+  """
+  Gets crcmod's CRC-16 function, if its C extension is available.
+  """
+  try:
+    import crcmod.predefined
+  except ImportError:
+    return None
+
+  if not getattr(sys.modules.get('crcmod.crcmod'), '_usingExtension', False):
+    return None
+
+  return crcmod.predefined.mkCrcFun('crc-16')
+
+# The available CRC-16 backends; see get_crc16_backends()
+_backends = None
+
+def get_crc16_backends():
+  """
+  Gets the available CRC-16 backends. The first call imports them.
+
+  @return list
+    A list of (name, function) tuples, fastest first.
+  """
+  global _backends, _numpy_table, numpy
+
+  if _backends is None:
+    _backends = []
+
+    crcmod_crc16 = _crcmod_crc16()
+
+    if crcmod_crc16 is not None:
+      _backends.append(('crcmod', crcmod_crc16))
+
+    try:
+      import numpy
+    except ImportError:
+      numpy = None
+    else:
+      _numpy_table = numpy.array(_tables[0], dtype = numpy.uint16)
+      _backends.append(('numpy', _crc16_numpy))
+
+    _backends.append(('table', _crc16_table))
+
+  return _backends
+
+def select_crc16_backend():
+  """
+  Chooses the CRC-16 backend to use (the fastest available, unless another is
+  named by the environment variable CRC16_BACKEND_ENV) and installs it as
+  crc16().
+
+  @return str
+    The name of the backend.
+  """
+  global crc16, crc16_backend
+
+  name = os.environ.get(CRC16_BACKEND_ENV)
+
+  # crcmod is the fastest backend; use it if we can without importing NumPy
+  # just to list the others
+  if _backends is None and name in (None, '', 'crcmod'):
+    crcmod_crc16 = _crcmod_crc16()
+
+    if crcmod_crc16 is not None:
+      crc16_backend, crc16 = 'crcmod', crcmod_crc16
+      return crc16_backend
+
+  backends = get_crc16_backends()
+
+  crc16_backend, crc16 = ([
+    backend for backend in backends if backend[0] == name
+  ] or backends)[0]
+
+  return crc16_backend
+
+"""
+The name of the CRC-16 backend in use, or None if it hasn't been chosen yet
+(see select_crc16_backend()).
+"""
+crc16_backend = None
+
+def crc16(data, crc=0):
+  """
+  Computes the CRC-16 check-sum of a string.
+
+  This takes an optional second argument, the CRC-16 of any preceding data,
+  so that long streams can be check-summed incrementally.
+
+  The backend is chosen on the first call, which replaces this function with
+  the backend's own.
+  """
+  select_crc16_backend()
+  return crc16(data, crc)
+
+def parse_size(size):
+  """
+  Parses a human-readable byte size such as '64K' or '8M'.
+
+  @param str size
+    The size to parse. A suffix of K, M, or G (optionally followed by 'iB' or
+    'B') multiplies the value by the corresponding power of 1024.
+
+  @return int
+    The size in bytes.
+  """
+  size = str(size).strip().upper()
+
+  for suffix in ('IB', 'B'):
+    if size.endswith(suffix) and size[:-len(suffix)][-1:] in _size_suffixes:
+      size = size[:-len(suffix)]
+      break
+
+  multiplier = _size_suffixes.get(size[-1:], 1)
+
+  if multiplier > 1:
+    size = size[:-1]
+
+  return int(size) * multiplier
+
+# Rotational-device lookups, by device number; see is_rotational()
+_rotational = {}
+
+def is_rotational(device):
+  """
+  Determines whether a device is a spinning disk, from what the kernel says
+  about it (or its parent, for a partition) in sysfs.
+
+  @param int device
+    The device number (i.e., a file's st_dev).
+
+  @return bool
+    True if the device is known to be rotational. Devices with no sysfs
+    entry (e.g., network file systems, or platforms other than Linux) are
+    assumed not to be.
+  """
+  if device in _rotational:
+    return _rotational[device]
+
+  rotational = False
+
+  try:
+    path = os.path.realpath(
+      '/sys/dev/block/%d:%d' % (os.major(device), os.minor(device))
+    )
+  except (AttributeError, OSError):
+    path = None
+
+  if path is not None:
+    for directory in (path, os.path.dirname(path)):
+      try:
+        with open(os.path.join(directory, 'queue', 'rotational')) as handle:
+          rotational = handle.read().strip() == '1'
+        break
+      except (IOError, OSError):
+        continue
+
+  _rotational[device] = rotational
+  return rotational
+
+def new_digest(name):
+  """
+  Creates a hash object for a digest.
+
+  @param str name
+    One of DIGESTS.
+
+  @return object
+    A hash object with update() and hexdigest() methods.
+
+  @raise ValueError
+    If the digest isn't available here.
+  """
+  if name == 'xxh64':
+    try:
+      import xxhash
+    except ImportError:
+      raise ValueError('xxh64 digests require the xxhash module')
+    return xxhash.xxh64()
+
+  if name not in DIGESTS:
+    raise ValueError('unknown digest: %s' % name)
+
+  try:
+    return hashlib.new(name)
+  except ValueError:
+    raise ValueError('%s digests are not supported by this Python' % name)
+
+def parse_shard(shard):
+  """
+  Parses a shard specification such as '2/4'.
+
+  @param str shard
+    The shard to parse, as K/N: shard K (counting from 1) of N.
+
+  @return tuple
+    The shard's index (counting from 0) and the number of shards.
+  """
+  index, count = (int(value) for value in str(shard).split('/'))
+
+  if count < 1 or not 1 <= index <= count:
+    raise ValueError('shard out of range: %s' % shard)
+
+  return (index - 1, count)
 
 def unpad_integer(integer, bits=7):
   """
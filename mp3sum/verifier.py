@@ -5,11 +5,11 @@ MP3 integrity-verification and related functions.
 """
 
 import os
-import sys
+import re
 import struct
 
-from distutils.version import LooseVersion
-
+from mp3sum import logging
+from mp3sum import readers
 from mp3sum import util
 
 ERROR_NOT_MP3        = -1
@@ -18,6 +18,10 @@ ERROR_UNSUPPORTED    = 2
 ERROR_TAG_MISMATCH   = 4
 ERROR_MUSIC_MISMATCH = 8
 
+# The tag CRC matched but the music CRC wasn't checked (--quick). This isn't
+# an error, so it's left out of the exit status
+ERROR_TAG_OK         = 16
+
 MPEG_FRAME_SYNC = 0xffe00000
 MPEG_VERSION_1  = 0x180000
 MPEG_LAYER_3    = 0x20000
@@ -33,26 +37,242 @@ INFO_VBR_MAGIC = b'Xing'
 
 LAME_VERSION_MAGIC = b'LAME'
 
-class Result(Exception):
-  def __init__(self, result, path):
-    self.result = result
-    self.path   = path
-    Exception.__init__(self, '%s yielded result: %i' % (path, result))
+# LAME versions before this don't do MusicCRC
+LAME_VERSION_MIN = (3, 90)
+
+ID3V1_MAGIC = b'TAG'
+ID3V1_SIZE  = 128
+
+APEV2_MAGIC       = b'APETAGEX'
+APEV2_FOOTER_SIZE = 32
+APEV2_FLAG_HEADER = 0x80000000
+
+LYRICS3_BEGIN_MAGIC = b'LYRICSBEGIN'
+LYRICS3V1_MAGIC     = b'LYRICSEND'
+LYRICS3V1_MAX_SIZE  = 5100
+LYRICS3V2_MAGIC     = b'LYRICS200'
+
+# Verification modes: check both CRCs, or only the info tag CRC
+MODE_FULL  = 'full'
+MODE_QUICK = 'quick'
+
+# The number of bytes read from the end of a file to look for tags; anything
+# further back is read as needed
+END_TAG_READ_SIZE = 512
 
-def is_mp3(path):
+class VerificationResult(object):
+  """
+  The outcome of verifying a single file.
+
+  The timings attribute maps the stages of the verification ('open',
+  'header', 'tail', 'read' and 'crc') and 'total' to the time spent on them,
+  in seconds. The digest attribute, if a digest was asked for and the audio
+  stream could be found, holds the digest's name and hex value (e.g.,
+  'sha256:9f86...'). The read_error attribute describes the error, if the
+  result is down to the file not being readable (which may pass, so such
+  results aren't cached), or is None.
+  """
+  __slots__ = (
+    'path',
+    'result',
+    'tag_crc_now',
+    'tag_crc',
+    'music_crc_now',
+    'music_crc',
+    'audio_start',
+    'audio_end',
+    'size',
+    'digest',
+    'read_error',
+    'messages',
+    'signature',
+    'cached',
+    'timings',
+  )
+
+  def __init__(self, path, result, crcs=None, messages=None):
+    """
+    @param str path
+      The path to the file.
+
+    @param int result
+      One of this module's error constants, or None if the music CRC is
+      still to be computed (see verify_file()).
+
+    @param tuple crcs
+      (optional) The computed and expected tag CRCs and the computed and
+      expected music CRCs (in that order). Missing values are stored as 0.
+
+    @param list messages
+      (optional) Debug messages produced during verification.
+    """
+    self.path        = path
+    self.result      = result
+    self.crcs        = crcs or (0, 0, 0, 0)
+    self.messages    = messages or []
+    self.audio_start = None
+    self.audio_end   = None
+    self.size        = None
+    self.digest      = None
+    self.read_error  = None
+    self.signature   = None
+    self.cached      = False
+    self.timings     = {}
+
+  def __repr__(self):
+    return '<%s %r result=%r crcs=%04X:%04X %04X:%04X>' % (
+      (type(self).__name__, self.path, self.result) + self.crcs
+    )
+
+  def __getstate__(self):
+    return tuple(getattr(self, slot) for slot in self.__slots__)
+
+  def __setstate__(self, state):
+    for slot, value in zip(self.__slots__, state):
+      setattr(self, slot, value)
+
+  @property
+  def crcs(self):
+    """
+    The computed and expected tag and music CRCs, as a tuple.
+    """
+    return (self.tag_crc_now, self.tag_crc, self.music_crc_now, self.music_crc)
+
+  @crcs.setter
+  def crcs(self, crcs):
+    (
+      self.tag_crc_now, self.tag_crc,
+      self.music_crc_now, self.music_crc
+    ) = (crc if crc else 0 for crc in crcs)
+
+  def debug(self, message, *args):
+    """
+    Records a debug message.
+
+    @param str message
+      The message, as a format string if any arguments are given.
+
+    @param mixed *args
+      (optional) The arguments for the format string.
+    """
+    self.messages.append(message % args if args else message)
+
+  def as_dict(self):
+    """
+    Gets the result as a dict of plain values (e.g., for JSON encoding).
+
+    @return dict
+    """
+    return {
+      'path':        self.path,
+      'result':      self.result,
+      'crcs':        list(self.crcs),
+      'audio_start': self.audio_start,
+      'audio_end':   self.audio_end,
+      'size':        self.size,
+      'digest':      self.digest,
+      'read_error':  self.read_error,
+      'cached':      self.cached,
+      'timings':     self.timings,
+      'messages':    self.messages,
+    }
+
+  @classmethod
+  def from_dict(cls, values):
+    """
+    Creates a result from a dict produced by as_dict().
+
+    @param dict values
+
+    @return VerificationResult
+    """
+    result = cls(
+      values['path'],
+      values['result'],
+      values.get('crcs'),
+      messages = values.get('messages')
+    )
+    result.audio_start = values.get('audio_start')
+    result.audio_end   = values.get('audio_end')
+    result.size        = values.get('size')
+    result.digest      = values.get('digest')
+    result.read_error  = values.get('read_error')
+    result.cached      = values.get('cached', False)
+    result.timings     = values.get('timings') or {}
+    return result
+
+class _Stopwatch(object):
+  """
+  Times the stages of a verification, adding each stage's duration (in
+  seconds) to a dict of timings.
+  """
+  def __init__(self, timings):
+    self.timings = timings
+    self.stage   = None
+    self.started = None
+
+  def start(self, stage):
+    """
+    Ends the current stage (if any) and starts another.
+
+    @param str stage
+      The name of the stage to start, or None to just end the current one.
+    """
+    now = util.clock()
+
+    if self.stage is not None:
+      self.timings[self.stage] = (
+        self.timings.get(self.stage, 0.0) + now - self.started
+      )
+
+    self.stage   = stage
+    self.started = now
+
+_lame_version_re = re.compile(br'(\d+)\.(\d+)')
+
+def _discard(message, *args):
+  pass
+
+def parse_lame_version(version):
+  """
+  Parses the version number from a LAME tag.
+
+  @param bytes version
+    The version string following 'LAME' in the tag (e.g., '3.99r').
+
+  @return tuple|None
+    The major and minor version numbers (e.g., (3, 99)), or None if the
+    string doesn't start with a version number.
+  """
+  match = _lame_version_re.match(version)
+
+  if match is None:
+    return None
+  return (int(match.group(1)), int(match.group(2)))
+
+def is_mp3(path, name=None, is_file=None):
   """
   Determines whether a file looks like an MP3.
 
   @param str path
     The path to the file to check.
 
+  @param str name
+    (optional) The file's base name, if already known.
+
+  @param bool is_file
+    (optional) Whether the path is a regular file, if already known (e.g.,
+    from a directory entry). If this is None, the file system is checked.
+
   @return bool
     True if the file seems like an MP3, False if not.
   """
-  if path.startswith('._'):
+  name = os.path.basename(path) if name is None else name
+
+  if name.startswith('._'):
     return False
-  if path.lower().endswith('.mp3'):
-    return os.path.isfile(path)
+  if name.lower().endswith('.mp3'):
+    return os.path.isfile(path) if is_file is None else is_file
   return False
 
 def find_frame(buffer):
@@ -71,349 +291,856 @@ def find_frame(buffer):
   except ValueError:
     return -1
 
-def verify_mp3(path, logger, options):
+def get_display_path(path, options):
+  """
+  Gets the path to show for a file in output.
+
+  @param str path
+    The path to the file.
+
+  @return str
+    The path as configured by the --absolute and --basename options.
+  """
+  try:
+    if options.absolute:
+      return os.path.abspath(path)
+    elif options.basename:
+      return os.path.basename(path)
+  except:
+    pass
+  return path
+
+def find_end_tags(reader, debug=_discard, audio_start=0):
+  """
+  Finds the tags at the end of an MP3 file.
+
+  An MP3 file is generally laid out like this:
+
+  [ID3v2][header/info][audio][Lyrics3v2][APEv2][ID3v1]
+
+  Each of the trailing tags can be located from the end of the file (or of
+  the tag after it), so they're peeled off one at a time, working backwards
+  from EOF, until no more are found. Only the bytes needed to identify each
+  tag are read.
+
+  @param FileReader reader
+    A reader for the file.
+
+  @param callable debug
+    (optional) A function to call with debug messages, as a format string
+    followed by its arguments.
+
+  @param int audio_start
+    (optional) The offset of the audio stream. Tags aren't looked for before
+    it, nor is anything before it read.
+
+  @return int|None
+    The offset of the first trailing tag (i.e., the end of the audio
+    stream), or None if there are no trailing tags.
+  """
+  tail_offset = max(audio_start, reader.size - END_TAG_READ_SIZE)
+  tail        = reader.read(tail_offset, reader.size - tail_offset)
+
+  def read(offset, length):
+    if offset >= tail_offset:
+      return tail[offset - tail_offset:offset - tail_offset + length]
+    return reader.read(offset, length)
+
+  end   = reader.size
+  found = None
+
+  while end > audio_start:
+    # ID3v1: 128 bytes starting with 'TAG'. This may be duplicated (this
+    # appeared during testing), so i suppose we should allow it. The 'TAG'
+    # mustn't be part of an APEv2 footer's 'APETAGEX', though
+    if (
+      end - audio_start >= ID3V1_SIZE
+      and read(end - ID3V1_SIZE, 3) == ID3V1_MAGIC
+      and read(max(audio_start, end - ID3V1_SIZE - 3), 8) != APEV2_MAGIC
+    ):
+      end -= ID3V1_SIZE
+      debug('Found ID3v1 tag at offset %s', util.format_offset(end))
+
+    # APEv2: a 32-byte footer giving the size of the tag, excluding the
+    # (optional) header
+    elif end - audio_start >= APEV2_FOOTER_SIZE and read(end - APEV2_FOOTER_SIZE, 8) == APEV2_MAGIC:
+      try:
+        apev2 = struct.unpack(
+          '< 8s I I I I 8x', read(end - APEV2_FOOTER_SIZE, APEV2_FOOTER_SIZE)
+        )
+      except struct.error:
+        break
+
+      start = end - apev2[2]
+      if apev2[4] & APEV2_FLAG_HEADER:
+        start -= APEV2_FOOTER_SIZE
+
+      if start < audio_start or apev2[2] < APEV2_FOOTER_SIZE:
+        debug('Bad APEv2 tag size %i', apev2[2])
+        break
+
+      end = start
+      debug('Found APEv2 tag at offset %s', util.format_offset(end))
+
+    # Lyrics3v2: a 6-digit size followed by 'LYRICS200'
+    elif end - audio_start >= 15 and read(end - 9, 9) == LYRICS3V2_MAGIC:
+      size = read(end - 15, 6)
+      if not size.isdigit():
+        break
+
+      start = end - 15 - int(size)
+      if start < audio_start or read(start, 11) != LYRICS3_BEGIN_MAGIC:
+        debug('Bad Lyrics3v2 tag size %s', int(size))
+        break
+
+      end = start
+      debug('Found Lyrics3v2 tag at offset %s', util.format_offset(end))
+
+    # Lyrics3v1: no size field, but it's limited to 5100 bytes
+    elif end - audio_start >= 9 and read(end - 9, 9) == LYRICS3V1_MAGIC:
+      length = min(end - audio_start, LYRICS3V1_MAX_SIZE + 11 + 9)
+      start  = read(end - length, length).rfind(LYRICS3_BEGIN_MAGIC)
+      if start < 0:
+        break
+
+      end = end - length + start
+      debug('Found Lyrics3v1 tag at offset %s', util.format_offset(end))
+
+    else:
+      break
+
+    found = end
+
+  return found
+
+def check_music_crc(music_crc_now, music_crc, debug=_discard):
+  """
+  Compares a computed music CRC against the expected one.
+
+  @param int music_crc_now
+    The computed music CRC.
+
+  @param int music_crc
+    The music CRC embedded in the file.
+
+  @param callable debug
+    (optional) A function to call with debug messages, as a format string
+    followed by its arguments.
+
+  @return int
+    ERROR_OK or ERROR_MUSIC_MISMATCH.
+  """
+  if music_crc != music_crc_now:
+    debug(
+      'Music CRC mismatch: computed %04X, expected %04X',
+      music_crc_now, music_crc
+    )
+    return ERROR_MUSIC_MISMATCH
+
+  debug('Computed music CRC: %04X', music_crc_now)
+  return ERROR_OK
+
+def verify_file(
+  path,
+  read_size  = util.READ_SIZE,
+  mode       = MODE_FULL,
+  use_mmap   = False,
+  split_size = None,
+  debug      = False,
+  progress   = None,
+  drop_cache = False,
+  direct     = False,
+  digest     = None
+):
   """
   Verifies the integrity of an MP3 file.
 
+  Nothing is printed or raised here (a file that can't be read is reported
+  as unsupported), so this is suitable for use as a library function.
+
   @param str path
     The path to the (possible) MP3 file to be verified.
 
-  @param Logger logger
-    A Logger instance for printing messages.
+  @param int read_size
+    (optional) The maximum number of bytes of audio to hold in memory at
+    once.
 
-  @return int
-    One of this module's error constants.
+  @param str mode
+    (optional) MODE_FULL to check both CRCs, or MODE_QUICK to stop after the
+    info tag CRC (yielding ERROR_TAG_OK if it matches).
+
+  @param bool use_mmap
+    (optional) Whether to read the file through a memory map.
+
+  @param int split_size
+    (optional) If the audio stream is at least this many bytes long, stop
+    short of computing the music CRC and return a result with a result code
+    of None and the audio_start/audio_end offsets filled in, so that the
+    caller can compute the CRC in parallel and pass it to
+    check_music_crc().
+
+  @param bool debug
+    (optional) Whether to collect debug messages in the result. These are
+    only formatted when this is set.
+
+  @param callable progress
+    (optional) A function to call with the number of bytes of audio
+    check-summed, as the music CRC is computed.
+
+  @param bool drop_cache
+    (optional) Whether to keep the file out of the page cache where
+    possible (see readers.FileReader).
+
+  @param bool direct
+    (optional) Whether to read the file with O_DIRECT (see
+    readers.open_reader()).
+
+  @param str digest
+    (optional) The name of a digest (one of util.DIGESTS) to compute over
+    the audio stream, in the same pass as the music CRC. This is computed
+    for files that fail or are unsupported too, as long as their audio
+    stream can be found, but not in quick mode; it rules out split_size.
+
+  @return VerificationResult
+    The result of the verification.
+
+  @raise ValueError
+    If the digest isn't available (see util.new_digest()).
+  """
+  return _verify_reader(
+    path,
+    lambda: readers.open_reader(path, use_mmap, drop_cache, direct),
+    read_size,
+    mode,
+    split_size,
+    debug,
+    progress,
+    digest
+  )
+
+def verify_stream(
+  handle,
+  path,
+  size      = None,
+  read_size = util.READ_SIZE,
+  mode      = MODE_FULL,
+  debug     = False,
+  progress  = None,
+  digest    = None,
+  tail_size = readers.TAIL_SIZE
+):
+  """
+  Verifies the integrity of an MP3 file that can only be read from start to
+  end, such as an archive member or a pipe, in one pass (see
+  readers.StreamReader).
+
+  @param file handle
+    The stream, opened in binary mode. It's left open.
+
+  @param str path
+    The path to report the file as.
+
+  @param int size
+    (optional) The size of the stream, if it's known in advance.
+
+  @param int read_size
+    (optional) See verify_file().
+
+  @param str mode
+    (optional) See verify_file().
+
+  @param bool debug
+    (optional) See verify_file().
+
+  @param callable progress
+    (optional) See verify_file().
+
+  @param str digest
+    (optional) See verify_file().
+
+  @param int tail_size
+    (optional) The number of bytes at the end of the stream to hold back
+    from the music CRC until EOF, which the trailing tags must fit in.
+
+  @return VerificationResult
+    The result of the verification.
+
+  @raise ValueError
+    If the digest isn't available (see util.new_digest()).
+  """
+  return _verify_reader(
+    path,
+    lambda: readers.StreamReader(handle, size, tail_size),
+    read_size,
+    mode,
+    None,
+    debug,
+    progress,
+    digest
+  )
+
+def _verify_reader(
+  path,
+  open_reader,
+  read_size,
+  mode,
+  split_size,
+  debug,
+  progress,
+  digest
+):
   """
+  Does the work for verify_file() and verify_stream(), given a function that
+  opens a reader for the file.
+  """
+  result  = VerificationResult(path, None)
+  log     = result.debug if debug else _discard
+  watch   = _Stopwatch(result.timings)
+  reader  = None
+  hasher  = util.new_digest(digest) if digest and mode == MODE_FULL else None
+  started = util.clock()
+
   try:
-    tag_crc       = None
-    tag_crc_now   = None
-    music_crc     = None
-    music_crc_now = None
+    watch.start('open')
+    reader = open_reader()
+
+    watch.start('header')
+    result.result = _verify(
+      result,
+      reader,
+      read_size,
+      mode,
+      split_size if hasher is None else None,
+      log,
+      watch,
+      progress,
+      hasher
+    )
 
-    try:
-      if options.absolute:
-        display_path = os.path.abspath(path)
-      elif options.basename:
-        display_path = os.path.basename(path)
+    # The audio stream of a file that couldn't be verified may still be
+    # found, for the digest's sake; otherwise, the offset found for it so
+    # far is forgotten
+    if result.audio_end is None and result.audio_start is not None:
+      if hasher is not None:
+        _find_audio(result, reader, read_size, log, watch, progress, hasher)
       else:
-        display_path = path
-    except:
-      display_path = path
+        result.audio_start = None
 
-    logger.debug('%s:' % display_path)
+    if result.digest is not None:
+      result.digest = '%s:%s' % (digest, result.digest)
+      log('Computed digest: %s', result.digest)
 
-    handle = open(path, 'rb')
-    chunk  = 1024
-    buffer = handle.read(chunk)
+  # The file couldn't be opened or read
+  except (IOError, OSError) as e:
+    log('Failed to read file: %s', e)
+    result.result     = ERROR_UNSUPPORTED
+    result.read_error = str(e)
 
-    # If we don't have a straight MP3 header, look for an ID3v2 tag to skip
-    while True:
-      frame = find_frame(buffer)
+  finally:
+    watch.start(None)
 
-      if frame == 0:
-        break
+    # Streams' sizes may only be known once they've been read
+    if reader is not None:
+      result.size = reader.size
+      reader.close()
 
-      try:
-        id3v2            = struct.unpack('> 3s x b b i', buffer[0:10])
-        id3v2_identifier = id3v2[0]
-        id3v2_revision   = id3v2[1]
-        id3v2_flags      = id3v2[2]
-        id3v2_length     = util.unpad_integer(id3v2[3])
-
-      # This is probably not an MP3 file at all
-      except struct.error as e:
-        logger.debug('No MP3 or ID3v2 signature near offset %s' % (
-          util.format_offset(handle.tell() - chunk)
-        ))
-        raise Result(ERROR_UNSUPPORTED, display_path)
-
-      # ID3v2 tags have an identifier of 'ID3' followed by a major
-      # version number and then a revision number < 0xFF
-      if id3v2_identifier != ID3V2_MAGIC or id3v2_revision > ID3V2_REVISION_MAX:
-        logger.debug('Bad ID3v2 signature at offset %s' % (
-          util.format_offset(handle.tell() - chunk)
-        ))
-        raise Result(ERROR_UNSUPPORTED, display_path)
-
-      logger.debug('Found ID3v2 signature at offset %s' % (
-        util.format_offset(handle.tell() - chunk)
-      ))
-      logger.debug('Found ID3v2 tag length of %i bytes' % id3v2_length)
-
-      # Extended header is enabled when bit 0100000 is set
-      if id3v2_flags & ID3V2_FLAG_EXTENDED:
-        logger.debug('Found ID3v2 extended header')
-
-      # Seek past the reported tag length and see if we can find our
-      # frame header
-      handle.seek(id3v2_length + 10 - chunk, 1)
-      buffer = handle.read(chunk)
-
-      # Another ID3v2 frame (sigh)
-      if buffer.find(ID3V2_MAGIC) == 0:
-        continue
-
-      frame = find_frame(buffer)
-
-      if frame < 0:
-        logger.debug('Missing MP3 frame header near offset %s' % (
-          util.format_offset(handle.tell() - chunk)
-        ))
-        raise Result(ERROR_UNSUPPORTED, display_path)
-
-    logger.debug('Found MP3 frame header at offset %s' % (
-      util.format_offset(handle.tell() - chunk + frame)
-    ))
+  result.timings['total'] = util.clock() - started
+
+  return result
+
+def _find_audio(result, reader, read_size, debug, watch, progress, hasher):
+  """
+  Finds the audio stream of a file that couldn't be verified, given the
+  offset of the first MPEG frame (or of the end of its Xing/Info data) in
+  result.audio_start, and computes its digest (as a bare hex value, which
+  verify_file() names).
+  """
+  buffer = reader.read(result.audio_start, 1024)
+  frame  = find_frame(buffer)
+
+  if frame < 0:
+    result.audio_start = None
+    return
+
+  result.audio_start += frame
+
+  try:
+    if reader.seekable:
+      watch.start('tail')
+      result.audio_end = find_end_tags(reader, debug) or reader.size
+      watch.start(None)
+
+      reader.crc16(
+        result.audio_start,
+        result.audio_end - result.audio_start,
+        read_size,
+        result.timings,
+        progress,
+        hasher
+      )
+    else:
+      _crc_stream(result, reader, read_size, debug, watch, progress, hasher)
+  except IOError as e:
+    debug('Failed to read audio stream')
+    result.read_error = str(e)
+    return
+
+  debug(
+    'Found audio stream between offsets %s and %s',
+    util.format_offset(result.audio_start),
+    util.format_offset(result.audio_end)
+  )
+
+  result.digest = hasher.hexdigest()
+
+def _crc_stream(result, reader, read_size, debug, watch, progress, hasher):
+  """
+  Computes the music CRC (and digest, if any) of a stream's audio stream,
+  from result.audio_start up to the trailing tags, filling in
+  result.audio_end.
+
+  The audio is check-summed on the way to EOF, bar the bytes held back by
+  the reader (see readers.StreamReader.crc16_to_tail()); the trailing tags
+  are then found among those, and the rest of the audio is added on.
+
+  @return int
+    The music CRC.
+
+  @raise IOError
+    If the stream can't be read, or its trailing tags are longer than the
+    bytes held back.
+  """
+  crc, tail = reader.crc16_to_tail(
+    result.audio_start, read_size, result.timings, progress, hasher
+  )
+
+  watch.start('tail')
+
+  # Tags reaching back past the bytes held back can't be read (though if
+  # the stream ended within them, they hold all of the audio)
+  try:
+    audio_end = find_end_tags(tail, debug, result.audio_start) or tail.size
+  except IOError:
+    audio_end = -1
+
+  watch.start(None)
+
+  if audio_end < tail.offset:
+    raise IOError(
+      'trailing tags are longer than the %d bytes held back' % len(tail.data)
+    )
+
+  result.audio_end = audio_end
+  rest             = tail.read(tail.offset, audio_end - tail.offset)
+
+  if hasher is not None:
+    hasher.update(rest)
+
+  if progress is not None:
+    progress(len(rest))
+
+  return util.crc16(rest, crc)
+
+def _verify(
+  result,
+  reader,
+  read_size,
+  mode,
+  split_size,
+  debug,
+  watch,
+  progress,
+  hasher = None
+):
+  """
+  Does the work for verify_file(), filling in the result (and its timings,
+  by stage) as it goes.
+
+  Once the first MPEG frame has been found, result.audio_start is kept
+  pointing at (or just before) the start of the audio stream, so that
+  verify_file() can find it even if the file can't be verified.
+
+  @return int|None
+    One of this module's error constants, or None if the music CRC has been
+    left for the caller.
+  """
+  offset = 0
+  chunk  = 1024
+  buffer = reader.read(offset, chunk)
+
+  # If we don't have a straight MP3 header, look for an ID3v2 tag to skip
+  while True:
+    frame = find_frame(buffer)
+
+    if frame == 0:
+      break
 
     try:
-      segment = buffer[frame:frame + 190 + 2]
-      info    = struct.unpack(
-        #  pre
-        #  |   Xing/Info
-        #  |   |  info data
-        #  |   |  |    LAME version
-        #  |   |  |    |  LAME data
-        #  |   |  |    |  |   music CRC
-        #  |   |  |    |  |   |  tag CRC
-        #  |   |  |    |  |   |  |
-        '> 36s 4s 116s 9s 23s H  H',
-        segment
+      id3v2            = struct.unpack('> 3s x b b i', buffer[0:10])
+      id3v2_identifier = id3v2[0]
+      id3v2_revision   = id3v2[1]
+      id3v2_flags      = id3v2[2]
+      id3v2_length     = util.unpad_integer(id3v2[3])
+
+    # This is probably not an MP3 file at all
+    except struct.error:
+      debug(
+        'No MP3 or ID3v2 signature near offset %s', util.format_offset(offset)
       )
-      info_tag  = info[1]
-
-      # Check for 'Xing'/'Info'
-      if info_tag != INFO_VBR_MAGIC and info_tag != INFO_CBR_MAGIC:
-        segment = buffer[frame:frame + 175 + 2]
-        info    = struct.unpack(
-          '> 21s 4s 116s 9s 23s H  H',
-          segment
-        )
+      return ERROR_UNSUPPORTED
+
+    # ID3v2 tags have an identifier of 'ID3' followed by a major
+    # version number and then a revision number < 0xFF
+    if id3v2_identifier != ID3V2_MAGIC or id3v2_revision > ID3V2_REVISION_MAX:
+      debug('Bad ID3v2 signature at offset %s', util.format_offset(offset))
+      return ERROR_UNSUPPORTED
 
-      info_tag  = info[1]
-      lame_tag  = info[3]
-      music_crc = info[5]
-      tag_crc   = info[6]
+    debug('Found ID3v2 signature at offset %s', util.format_offset(offset))
+    debug('Found ID3v2 tag length of %i bytes', id3v2_length)
 
-      logger.debug('Unpacked %i bytes between offsets %s and %s' % (
-        len(segment),
-        util.format_offset(handle.tell() - chunk + frame),
-        util.format_offset(handle.tell() - chunk + frame + len(segment))
-      ))
+    # Extended header is enabled when bit 0100000 is set
+    if id3v2_flags & ID3V2_FLAG_EXTENDED:
+      debug('Found ID3v2 extended header')
 
-    except struct.error as e:
-      logger.debug('Failed to unpack header near offset %s: %s' % (
-        util.format_offset(handle.tell() - chunk + frame), e
-      ))
-      raise Result(ERROR_UNSUPPORTED, display_path)
+    # Seek past the reported tag length and see if we can find our
+    # frame header
+    offset += id3v2_length + 10
+    buffer  = reader.read(offset, chunk)
+
+    # Another ID3v2 frame (sigh)
+    if buffer.find(ID3V2_MAGIC) == 0:
+      continue
+
+    frame = find_frame(buffer)
+
+    if frame < 0:
+      debug(
+        'Missing MP3 frame header near offset %s', util.format_offset(offset)
+      )
+      return ERROR_UNSUPPORTED
+
+  debug(
+    'Found MP3 frame header at offset %s', util.format_offset(offset + frame)
+  )
+
+  result.audio_start = offset + frame
+
+  try:
+    segment = buffer[frame:frame + 190 + 2]
+    info    = struct.unpack(
+      #  pre
+      #  |   Xing/Info
+      #  |   |  info data
+      #  |   |  |    LAME version
+      #  |   |  |    |  LAME data
+      #  |   |  |    |  |   music CRC
+      #  |   |  |    |  |   |  tag CRC
+      #  |   |  |    |  |   |  |
+      '> 36s 4s 116s 9s 23s H  H',
+      segment
+    )
+    info_tag  = info[1]
 
     # Check for 'Xing'/'Info'
     if info_tag != INFO_VBR_MAGIC and info_tag != INFO_CBR_MAGIC:
-      logger.debug('Unexpected Xing/Info tag data %s' % info_tag)
-      tag_crc   = 0
-      music_crc = 0
-      raise Result(ERROR_UNSUPPORTED, display_path)
+      segment = buffer[frame:frame + 175 + 2]
+      info    = struct.unpack(
+        '> 21s 4s 116s 9s 23s H  H',
+        segment
+      )
 
-    logger.debug('Found Xing/Info tag %s' % info_tag)
+    info_tag = info[1]
+    lame_tag = info[3]
 
-    # Check for 'LAME'
-    if not lame_tag.startswith(LAME_VERSION_MAGIC):
-      logger.debug('Bad LAME tag %s; trying anyway' % lame_tag)
-    # Check version number
-    else:
-      try:
-        lame_version = LooseVersion(lame_tag[4:9].decode('utf-8'))
-        lame_version < LooseVersion('3.90') # Catch incompatible versions
-      except:
-        lame_version = None
-
-      # If the above failed, it's probably because some stupid scene group
-      # messed with the version string
-      if lame_version is None:
-        logger.debug('Bad LAME tag %s; trying anyway' % lame_tag)
-      # LAME versions <3.90 don't do MusicCRC
-      elif lame_version < LooseVersion('3.90'):
-        logger.debug('Insufficient LAME version %s' % lame_tag)
-        raise Result(ERROR_UNSUPPORTED, display_path)
-      else:
-        logger.debug('Found LAME tag %s' % lame_tag)
+    result.music_crc = info[5]
+    result.tag_crc   = info[6]
 
-    # If one of our CRCs is all zeroes, it's probably busted
-    if tag_crc == 0 or music_crc == 0:
-      logger.debug('Bad CRC values %s, %s' % (tag_crc, music_crc))
-      raise Result(ERROR_UNSUPPORTED, display_path)
+    debug(
+      'Unpacked %i bytes between offsets %s and %s',
+      len(segment),
+      util.format_offset(offset + frame),
+      util.format_offset(offset + frame + len(segment))
+    )
 
-    logger.debug('Found tag CRC: %04X (%i), music CRC: %04X (%i)' % (
-      tag_crc, tag_crc, music_crc, music_crc
-    ))
+  except struct.error as e:
+    debug(
+      'Failed to unpack header near offset %s: %s',
+      util.format_offset(offset + frame), e
+    )
+    return ERROR_UNSUPPORTED
+
+  # Check for 'Xing'/'Info'
+  if info_tag != INFO_VBR_MAGIC and info_tag != INFO_CBR_MAGIC:
+    debug('Unexpected Xing/Info tag data %s', info_tag)
+    result.tag_crc   = 0
+    result.music_crc = 0
+    return ERROR_UNSUPPORTED
+
+  debug('Found Xing/Info tag %s', info_tag)
+
+  # The Xing/Info frame isn't part of the audio stream
+  result.audio_start = offset + frame + len(segment)
+
+  # Check for 'LAME'
+  if not lame_tag.startswith(LAME_VERSION_MAGIC):
+    debug('Bad LAME tag %s; trying anyway', lame_tag)
+  # Check version number
+  else:
+    lame_version = parse_lame_version(lame_tag[4:9])
+
+    # If the above failed, it's probably because some stupid scene group
+    # messed with the version string
+    if lame_version is None:
+      debug('Bad LAME tag %s; trying anyway', lame_tag)
+    # LAME versions <3.90 don't do MusicCRC
+    elif lame_version < LAME_VERSION_MIN:
+      debug('Insufficient LAME version %s', lame_tag)
+      return ERROR_UNSUPPORTED
+    else:
+      debug('Found LAME tag %s', lame_tag)
 
-    # Compute tag CRC
-    tag_crc_now = util.crc16(buffer[frame:frame + len(segment) - 2])
+  # If one of our CRCs is all zeroes, it's probably busted
+  if result.tag_crc == 0 or result.music_crc == 0:
+    debug('Bad CRC values %s, %s', result.tag_crc, result.music_crc)
+    return ERROR_UNSUPPORTED
 
-    if tag_crc_now != tag_crc:
-      logger.debug('Tag CRC mismatch: computed %04X, expected %04X' % (
-        tag_crc_now, tag_crc
-      ))
-      raise Result(ERROR_TAG_MISMATCH, display_path)
+  debug(
+    'Found tag CRC: %04X (%i), music CRC: %04X (%i)',
+    result.tag_crc, result.tag_crc, result.music_crc, result.music_crc
+  )
 
-    logger.debug('Computed tag CRC: %04X' % tag_crc_now)
+  # Compute tag CRC
+  result.tag_crc_now = util.crc16(buffer[frame:frame + len(segment) - 2])
 
-    # Find next MPEG frame so we can compute the music CRC
-    handle.seek(handle.tell() - chunk + frame + len(segment))
-    buffer = handle.read(chunk)
+  if result.tag_crc_now != result.tag_crc:
+    debug(
+      'Tag CRC mismatch: computed %04X, expected %04X',
+      result.tag_crc_now, result.tag_crc
+    )
+    return ERROR_TAG_MISMATCH
 
-    next_frame        = find_frame(buffer)
-    next_frame_offset = handle.tell() - chunk + next_frame
+  debug('Computed tag CRC: %04X', result.tag_crc_now)
 
-    if next_frame < 0:
-      logger.debug('Music CRC computation failed — missing next frame')
-      raise Result(ERROR_MUSIC_MISMATCH, display_path)
+  if mode == MODE_QUICK:
+    debug('Skipping music CRC (quick mode)')
+    return ERROR_TAG_OK
 
-    logger.debug('Found next frame (%s) at offset %s' % (
-      buffer[next_frame:next_frame + 4],
-      util.format_offset(next_frame_offset)
-    ))
+  # Find next MPEG frame so we can compute the music CRC
+  offset = offset + frame + len(segment)
+  buffer = reader.read(offset, chunk)
 
-    #raise Result(ERROR_UNSUPPORTED, display_path)
+  next_frame        = find_frame(buffer)
+  next_frame_offset = offset + next_frame
 
-    # Now we have to work on the tags at the end. An MP3 file is generally
-    # laid out like this:
-    #
-    # [ID3v2][header/info][audio][Lyrics3v2][APEv2][ID3v1]
-    #
-    # Let's assume that all of that junk on the end will fit into the last
-    # 512 KiB of the file...
-    try:
-      end_chunk_size = 512 * 1024
-      handle.seek(end_chunk_size * -1, 2)
-      buffer         = handle.read()
-    # If the above fails, the file is probably too short, so let's just go
-    # back to the beginning and read the entire thing
-    except IOError:
-      end_chunk_size = 0
-      handle.seek(0, 0)
-      buffer         = handle.read()
-
-    # Try to obtain the index of the Lyrics3v2 tag
-    try:
-      lyrics3v2_offset = buffer.index(b'LYRICSBEGIN')
-      if end_chunk_size > 0:
-        lyrics3v2_offset = handle.tell() - end_chunk_size + lyrics3v2_offset
-      logger.debug('Found Lyrics3v2 tag at offset %s' % (
-        util.format_offset(lyrics3v2_offset)
-      ))
-    except ValueError:
-      lyrics3v2_offset = None
-
-    # Try to obtain the index of the APE tag
-    try:
-      apev2_offset = buffer.index(b'APETAGEX')
-      if end_chunk_size > 0:
-        apev2_offset = handle.tell() - end_chunk_size + apev2_offset
-      logger.debug('Found APEv2 tag at offset %s' % (
-        util.format_offset(apev2_offset)
-      ))
-    except ValueError:
-      apev2_offset = None
-
-    # Try to obtain the index of the ID3v1 tag — for this one we'll get the
-    # last 259 bytes of the file (256 bytes + length of 'TAG' header)
-    try:
-      handle.seek(-259, 2)
-      buffer = handle.read()
-    except OSError:
-      handle.seek(-131, 0)
-      buffer = handle.read()
-
-    # We're going to test to see if this is either 128 OR 256 bytes from
-    # EOF — apparently sometimes the ID3 tag can get duplicated (this
-    # appeared during testing), so i suppose we should allow it. If it
-    # doesn't appear at one of these points, it's probably not an ID3v1 tag
-    # 256 bytes
-    if buffer[3:6] == b'TAG' and buffer[0:8] != b'APETAGEX':
-      if not end_chunk_size:
-        handle.seek(0, 2)
-      id3v1_offset = handle.tell() - 256
-    # 128 bytes
-    elif len(buffer) > 131 and buffer[131:134] == b'TAG' and buffer[128:136] != b'APETAGEX':
-      if not end_chunk_size:
-        handle.seek(0, 2)
-      id3v1_offset = handle.tell() - 128
-    # Not present
-    else:
-      id3v1_offset = None
+  if next_frame < 0:
+    debug('Music CRC computation failed — missing next frame')
+    return ERROR_MUSIC_MISMATCH
 
-    if id3v1_offset:
-      logger.debug('Found ID3v1 tag at offset %s' % (
-        util.format_offset(id3v1_offset)
-      ))
+  debug(
+    'Found next frame (%s) at offset %s',
+    buffer[next_frame:next_frame + 4],
+    util.format_offset(next_frame_offset)
+  )
 
-    # Get the lowest offset and use that as the end of our audio stream
-    try:
-      audio_end_offset = filter(None, [lyrics3v2_offset, apev2_offset, id3v1_offset])
-      audio_end_offset = min(audio_end_offset)
-    # If there's no lowest offset, there's nothing at the end to worry about
-    except (ValueError, TypeError):
-      audio_end_offset = None
-
-    logger.debug('Found audio stream end at offset %s' % (
-      util.format_offset(audio_end_offset) if audio_end_offset else 'EOF'
-    ))
-    logger.debug('Found audio stream length of %s bytes' % (
-      (audio_end_offset - next_frame_offset) if audio_end_offset else 'EOF'
-    ))
-
-    # Try to pull the audio stream
-    handle.seek(next_frame_offset, 0)
+  result.audio_start = next_frame_offset
 
+  # Streams can't be read from the end, so their trailing tags are only
+  # found once their audio has been check-summed
+  if not reader.seekable:
     try:
-      if audio_end_offset:
-        buffer = handle.read(audio_end_offset - next_frame_offset)
-      else:
-        buffer = handle.read()
-    except IOError:
-      logger.debug('Failed to parse audio stream')
-      raise Result(ERROR_MUSIC_MISMATCH, display_path)
+      result.music_crc_now = _crc_stream(
+        result, reader, read_size, debug, watch, progress, hasher
+      )
+    except IOError as e:
+      debug('Failed to parse audio stream: %s', e)
+      # The stream has been used up, so there's no finding it again
+      result.audio_start = None
+      return ERROR_MUSIC_MISMATCH
+
+    debug(
+      'Found audio stream end at offset %s',
+      util.format_offset(result.audio_end)
+    )
 
-    music_crc_now = util.crc16(buffer)
+    if hasher is not None:
+      result.digest = hasher.hexdigest()
 
-    if music_crc != music_crc_now:
-      logger.debug('Music CRC mismatch: computed %04X, expected %04X' % (
-        music_crc_now, music_crc
-      ))
-      raise Result(ERROR_MUSIC_MISMATCH, display_path)
+    return check_music_crc(result.music_crc_now, result.music_crc, debug)
 
-    logger.debug('Computed music CRC: %04X' % music_crc_now)
+  # Now we have to work on the tags at the end
+  watch.start('tail')
+  audio_end_offset = find_end_tags(reader, debug)
+  watch.start(None)
 
-    raise Result(ERROR_OK, display_path)
+  debug(
+    'Found audio stream end at offset %s',
+    util.format_offset(audio_end_offset) if audio_end_offset else 'EOF'
+  )
+  debug(
+    'Found audio stream length of %s bytes',
+    (audio_end_offset - next_frame_offset) if audio_end_offset else 'EOF'
+  )
 
-  # SIGINT handling
-  except (KeyboardInterrupt, SystemExit):
-    return ERROR_NOT_MP3
+  result.audio_end = audio_end_offset or reader.size
 
-  # Handle result printing
-  except Result as e:
-    tag_crc       = '%04X' % (tag_crc       if tag_crc       else 0)
-    tag_crc_now   = '%04X' % (tag_crc_now   if tag_crc_now   else 0)
-    music_crc     = '%04X' % (music_crc     if music_crc     else 0)
-    music_crc_now = '%04X' % (music_crc_now if music_crc_now else 0)
+  # Leave large audio streams for the caller to split up
+  if split_size and result.audio_end - result.audio_start >= split_size:
+    debug(
+      'Deferring music CRC of %i-byte audio stream',
+      result.audio_end - result.audio_start
+    )
+    return None
 
-    final_result  = '%s:%s %s:%s' % (
-      tag_crc_now, tag_crc,
-      music_crc_now, music_crc
+  # Compute the music CRC over the audio stream a chunk at a time, so that
+  # memory use doesn't grow with the size of the file
+  try:
+    result.music_crc_now = reader.crc16(
+      result.audio_start,
+      result.audio_end - result.audio_start,
+      read_size,
+      result.timings,
+      progress,
+      hasher
     )
+  except IOError as e:
+    debug('Failed to parse audio stream')
+    result.read_error = str(e)
+    return ERROR_MUSIC_MISMATCH
+
+  if hasher is not None:
+    result.digest = hasher.hexdigest()
+
+  return check_music_crc(result.music_crc_now, result.music_crc, debug)
+
+def verify_mp3(path, options, split_size=None, progress=None):
+  """
+  Verifies the integrity of an MP3 file as configured by the command-line
+  options (see verify_file()).
+
+  @param str path
+    The path to the (possible) MP3 file to be verified.
+
+  @param argparse.Namespace options
+    The parsed command-line options.
 
-    if options.show_pass and e.result == ERROR_OK:
-      logger.warn('P %s' % final_result, fg = 'green', end = ' ')
-      logger.warn(display_path)
-    if options.show_skip and e.result == ERROR_UNSUPPORTED:
-      logger.warn('U %s' % final_result, fg = 'yellow', end = ' ')
-      logger.warn(display_path)
-    if options.show_fail and e.result == ERROR_TAG_MISMATCH:
-      logger.warn('F %s' % final_result, fg = 'red', end = ' ')
-      logger.warn(display_path)
-    if options.show_fail and e.result == ERROR_MUSIC_MISMATCH:
-      logger.warn('F %s' % final_result, fg = 'red', end = ' ')
-      logger.warn(display_path)
-
-    logger.debug('')
-    return e.result
+  @param int split_size
+    (optional) See verify_file().
+
+  @param callable progress
+    (optional) See verify_file().
+
+  @return VerificationResult
+    The result of the verification.
+  """
+  return verify_file(
+    path,
+    read_size  = options.read_size,
+    mode       = MODE_QUICK if options.quick else MODE_FULL,
+    use_mmap   = options.mmap,
+    split_size = split_size,
+    debug      = (
+      options.log_level is not None and options.log_level <= logging.DEBUG
+    ),
+    progress   = progress,
+    drop_cache = options.drop_cache,
+    direct     = options.direct,
+    digest     = options.digest
+  )
+
+def verify_mp3_stream(handle, path, options, size=None, progress=None):
+  """
+  Verifies the integrity of an MP3 file that can only be read from start to
+  end as configured by the command-line options (see verify_stream()).
+
+  @param file handle
+    The stream, opened in binary mode. It's left open.
+
+  @param str path
+    The path to report the file as.
+
+  @param argparse.Namespace options
+    The parsed command-line options.
+
+  @param int size
+    (optional) See verify_stream().
+
+  @param callable progress
+    (optional) See verify_file().
+
+  @return VerificationResult
+    The result of the verification.
+  """
+  return verify_stream(
+    handle,
+    path,
+    size,
+    read_size = options.read_size,
+    mode      = MODE_QUICK if options.quick else MODE_FULL,
+    debug     = (
+      options.log_level is not None and options.log_level <= logging.DEBUG
+    ),
+    progress  = progress,
+    digest    = options.digest,
+    tail_size = options.tail_size
+  )
+
+def is_shown(options, result):
+  """
+  Determines whether a result is to be shown, as configured by the
+  --only-fail and --only-unsupported options.
+
+  @param argparse.Namespace options
+    The parsed command-line options.
+
+  @param VerificationResult result
+    The result to check.
+
+  @return bool
+  """
+  if result.result in (ERROR_OK, ERROR_TAG_OK):
+    return bool(options.show_pass)
+  if result.result == ERROR_UNSUPPORTED:
+    return bool(options.show_skip)
+  if result.result in (ERROR_TAG_MISMATCH, ERROR_MUSIC_MISMATCH):
+    return bool(options.show_fail)
+  return False
+
+def print_result(logger, options, result):
+  """
+  Prints the result line (and any debug messages) for a verified file.
+
+  @param Logger logger
+    A Logger instance for printing messages.
+
+  @param VerificationResult result
+    The result to print.
+  """
+  display_path = get_display_path(result.path, options)
+  final_result = '%04X:%04X %04X:%04X' % result.crcs
+
+  # Files whose audio stream couldn't be found have no digest
+  if options.digest is not None:
+    final_result += ' %s' % (result.digest or '-')
+
+  logger.debug('%s:' % display_path)
+
+  for message in result.messages:
+    logger.debug(message)
+
+  if options.show_pass and result.result == ERROR_OK:
+    logger.warn('P %s' % final_result, fg = 'green', end = ' ')
+    logger.warn(display_path)
+  if options.show_pass and result.result == ERROR_TAG_OK:
+    logger.warn('T %s' % final_result, fg = 'cyan', end = ' ')
+    logger.warn(display_path)
+  if options.show_skip and result.result == ERROR_UNSUPPORTED:
+    logger.warn('U %s' % final_result, fg = 'yellow', end = ' ')
+    logger.warn(display_path)
+  if options.show_fail and result.result == ERROR_TAG_MISMATCH:
+    logger.warn('F %s' % final_result, fg = 'red', end = ' ')
+    logger.warn(display_path)
+  if options.show_fail and result.result == ERROR_MUSIC_MISMATCH:
+    logger.warn('F %s' % final_result, fg = 'red', end = ' ')
+    logger.warn(display_path)
+
+  logger.debug('')
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+"""
+Watch mode (--watch).
+
+Rather than scanning the paths given, the watcher waits for files to be
+written or moved into them, and verifies just those, through a pool of
+workers kept running in between. Changes are noticed with inotify where the
+platform has it, or else by scanning the paths periodically.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from mp3sum import cache
+from mp3sum import discovery
+from mp3sum import engine
+from mp3sum import util
+from mp3sum import verifier
+
+"""
+The number of seconds a file must go without further changes before it's
+verified, so that a file written in several goes is only verified once.
+"""
+SETTLE_TIME = 2.0
+
+"""
+The default number of seconds between scans, when changes are noticed by
+scanning rather than with inotify.
+"""
+POLL_INTERVAL = 5.0
+
+# Event masks from <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_Q_OVERFLOW  = 0x00004000
+_IN_IGNORED     = 0x00008000
+_IN_ISDIR       = 0x40000000
+_IN_NONBLOCK    = os.O_NONBLOCK
+_IN_CLOEXEC     = 0o2000000
+
+# inotify_event, less the name that follows it: wd, mask, cookie, len
+_event = struct.Struct('iIII')
+
+def _decode_name(name):
+  name = name.rstrip(b'\0')
+  return os.fsdecode(name) if hasattr(os, 'fsdecode') else name
+
+class _Inotify(object):
+  """
+  Notices changes with inotify. Files are reported when they're closed after
+  being written, or moved in; directories created or moved in are watched
+  too, if recursive, and any files already in them are reported.
+  """
+  name = 'inotify'
+
+  def __init__(self, paths, recursive=False, onerror=None):
+    """
+    @param list paths
+      The file and directory paths to watch.
+
+    @param bool recursive
+      (optional) Whether to watch sub-directories.
+
+    @param callable onerror
+      (optional) A function to call with the OSError raised when a directory
+      can't be watched. Such directories are skipped.
+
+    @raise OSError
+      If inotify isn't available, or the limit on watches has been reached.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+
+    if not hasattr(libc, 'inotify_init1'):
+      raise OSError(errno.ENOSYS, 'inotify not available')
+
+    self.paths     = paths
+    self.recursive = recursive
+    self.onerror   = onerror
+    self.watches   = {} # Watched paths, by watch descriptor
+
+    self._add_watch = libc.inotify_add_watch
+    self._fd        = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+
+    if self._fd < 0:
+      code = ctypes.get_errno()
+      raise OSError(code, os.strerror(code))
+
+    try:
+      for path in paths:
+        self._add_tree(path)
+    except OSError:
+      self.close()
+      raise
+
+  def _add(self, path):
+    """
+    Watches a file or directory.
+
+    @raise OSError
+      If the limit on watches has been reached. Other errors go to onerror.
+    """
+    is_dir = os.path.isdir(path)
+    mask   = _IN_CLOSE_WRITE | _IN_MOVED_TO | (_IN_CREATE if is_dir else 0)
+    raw    = os.fsencode(path) if hasattr(os, 'fsencode') else path
+    wd     = self._add_watch(self._fd, raw, mask)
+
+    if wd < 0:
+      code  = ctypes.get_errno()
+      error = OSError(code, os.strerror(code), path)
+
+      if code == errno.ENOSPC:
+        raise error
+      if self.onerror is not None:
+        self.onerror(error)
+      return
+
+    self.watches[wd] = path
+
+  def _add_tree(self, path):
+    """
+    Watches a file or directory and, if recursive, its sub-directories.
+    """
+    self._add(path)
+
+    if not self.recursive or not os.path.isdir(path):
+      return
+
+    for directory, sub_dirs, names in os.walk(path, onerror = self.onerror):
+      for name in sub_dirs:
+        sub_path = os.path.join(directory, name)
+
+        # Not followed by find_mp3s() either
+        if not os.path.islink(sub_path):
+          self._add(sub_path)
+
+  def read(self, timeout=None):
+    """
+    Waits for changes.
+
+    @param float timeout
+      (optional) The number of seconds to wait, or None to wait for as long
+      as it takes.
+
+    @return list
+      The paths of the MP3 files changed, if any.
+    """
+    changed = []
+
+    if not select.select([self._fd], [], [], timeout)[0]:
+      return changed
+
+    while True:
+      try:
+        data = os.read(self._fd, 65536)
+      except OSError as e:
+        if e.errno == errno.EAGAIN:
+          break
+        raise
+
+      offset = 0
+
+      while offset < len(data):
+        wd, mask, cookie, length = _event.unpack_from(data, offset)
+        offset += _event.size + length
+        name    = _decode_name(data[offset - length:offset])
+
+        # Events were lost; anything could have changed
+        if mask & _IN_Q_OVERFLOW:
+          changed.extend(
+            discovery.find_mp3s(self.paths, self.recursive, self.onerror)
+          )
+          continue
+
+        if mask & _IN_IGNORED:
+          self.watches.pop(wd, None)
+          continue
+
+        if wd not in self.watches:
+          continue
+
+        path = self.watches[wd]
+        path = os.path.join(path, name) if name else path
+
+        if mask & _IN_ISDIR:
+          if self.recursive:
+            try:
+              self._add_tree(path)
+            except OSError as e:
+              if self.onerror is not None:
+                self.onerror(e)
+            changed.extend(discovery.find_mp3s([path], True, self.onerror))
+        elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO) and verifier.is_mp3(path):
+          changed.append(path)
+
+    return changed
+
+  def close(self):
+    os.close(self._fd)
+
+class _Poller(object):
+  """
+  Notices changes by scanning the paths periodically. A file is reported
+  once its stat signature differs from the last one reported but matches
+  the one from the scan before, so files still being written are left until
+  they stop changing.
+  """
+  name = 'polling'
+
+  def __init__(
+    self,
+    paths,
+    recursive = False,
+    onerror   = None,
+    interval  = POLL_INTERVAL
+  ):
+    """
+    @param list paths
+      The file and directory paths to watch.
+
+    @param bool recursive
+      (optional) Whether to watch sub-directories.
+
+    @param callable onerror
+      (optional) A function to call with the OSError raised when a directory
+      can't be read. Such directories are skipped.
+
+    @param float interval
+      (optional) The number of seconds between scans.
+    """
+    self.paths     = paths
+    self.recursive = recursive
+    self.onerror   = onerror
+    self.interval  = interval
+    self.seen      = self._scan() # Signatures from the last scan
+    self.known     = dict(self.seen) # Signatures last reported
+    self.scanned   = util.clock()
+
+  def _scan(self):
+    signatures = {}
+
+    for path in discovery.find_mp3s(self.paths, self.recursive, self.onerror):
+      try:
+        signatures[path] = cache.get_signature(path)
+      except OSError:
+        pass
+
+    return signatures
+
+  def read(self, timeout=None):
+    """
+    Waits for changes.
+
+    @param float timeout
+      (optional) The number of seconds to wait, or None to wait until the
+      next scan.
+
+    @return list
+      The paths of the MP3 files changed, if any.
+    """
+    wait = self.scanned + self.interval - util.clock()
+
+    if timeout is not None and timeout < wait:
+      time.sleep(max(0.0, timeout))
+      return []
+
+    time.sleep(max(0.0, wait))
+
+    seen         = self._scan()
+    self.scanned = util.clock()
+    changed      = []
+
+    for path, signature in seen.items():
+      if signature != self.known.get(path) and signature == self.seen.get(path):
+        self.known[path] = signature
+        changed.append(path)
+
+    for path in list(self.known):
+      if path not in seen:
+        del self.known[path]
+
+    self.seen = seen
+    return changed
+
+  def close(self):
+    pass
+
+def create_monitor(paths, recursive=False, onerror=None, interval=None):
+  """
+  Starts watching for changes.
+
+  @param list paths
+    The file and directory paths to watch.
+
+  @param bool recursive
+    (optional) Whether to watch sub-directories.
+
+  @param callable onerror
+    (optional) A function to call with the OSError raised when a directory
+    can't be watched. Such directories are skipped.
+
+  @param float interval
+    (optional) The number of seconds between scans. If this is None,
+    inotify is used where it's available, with scans every POLL_INTERVAL
+    seconds otherwise.
+
+  @return object
+    An object with a read() method that waits for changes (see
+    _Inotify.read()), a close() method, and a name.
+  """
+  if interval is None:
+    try:
+      return _Inotify(paths, recursive, onerror)
+    except (AttributeError, OSError, TypeError):
+      interval = POLL_INTERVAL
+
+  return _Poller(paths, recursive, onerror, interval)
+
+def settle(monitor, settle_time=SETTLE_TIME):
+  """
+  Groups changes into batches, holding each file back until it has gone
+  settle_time seconds without changing again.
+
+  @param object monitor
+    A monitor created by create_monitor().
+
+  @param float settle_time
+    (optional) The number of seconds to wait for changes to stop.
+
+  @return generator
+    Lists of paths, in sorted order, for as long as the caller wants them.
+  """
+  pending = {} # The times at which files may be verified, by path
+
+  while True:
+    timeout = None
+
+    if pending:
+      timeout = max(0.0, min(pending.values()) - util.clock())
+
+    for path in monitor.read(timeout):
+      pending[path] = util.clock() + settle_time
+
+    now   = util.clock()
+    ready = sorted(path for path, due in pending.items() if due <= now)
+
+    for path in ready:
+      del pending[path]
+
+    if ready:
+      yield ready
+
+def run(paths, options, store=None, logger=None):
+  """
+  Verifies files as they're written to (or moved into) the paths given,
+  until interrupted.
+
+  @param list paths
+    The file and directory paths to watch.
+
+  @param argparse.Namespace options
+    The parsed command-line options. If options.recursive is set,
+    sub-directories are watched too; if options.watch_poll is set, changes
+    are noticed by scanning at that interval instead of with inotify.
+
+  @param Cache store
+    (optional) A result cache to consult and update. It's committed after
+    each batch of changes.
+
+  @param Logger logger
+    (optional) A Logger instance for printing messages.
+
+  @return generator
+    VerificationResult instances.
+  """
+  def onerror(e):
+    if logger is not None:
+      logger.warn(
+        'cannot watch: %s' % e, prefix = True, file = sys.stderr
+      )
+
+  monitor = create_monitor(paths, options.recursive, onerror, options.watch_poll)
+  pool    = None
+
+  if logger is not None:
+    logger.info('Watching %d path(s) using %s' % (len(paths), monitor.name))
+
+  try:
+    # Kept for the whole run, rather than started for every batch
+    if options.workers > 1:
+      pool = engine.create_pool(options)
+
+    for batch in settle(monitor):
+      if logger is not None:
+        logger.info('Checking %d changed file(s)' % len(batch))
+
+      for result in engine.run(batch, options, store, pool):
+        yield result
+
+      if store is not None:
+        store.commit()
+  finally:
+    monitor.close()
+
+    if pool is not None:
+      pool.terminate()